@@ -5,63 +5,709 @@
 - 채팅 검색/내보내기
 - 테마 설정
 """
-import os, io, traceback, json, re
+import os, io, sys, traceback, json, re, asyncio, math, hashlib, heapq, threading, time, tempfile, shutil, zlib
+import ipaddress
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from typing import List, Dict
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict, deque, Counter, defaultdict
+from itertools import islice
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile, File, Form, Query
+from fastapi import FastAPI, UploadFile, File, Form, Query, Request
 from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from anthropic import Anthropic, APIConnectionError, RateLimitError, APIStatusError
+from anthropic import AsyncAnthropic, APIConnectionError, RateLimitError, APIStatusError
 import PyPDF2
+from pdf_worker import extract_pages
 import csv
 import zipfile
 import docx  # python-docx
 import openpyxl  # 엑셀
 import pptx  # python-pptx
+try:
+    import pyarrow.parquet as pq  # 선택 - 있으면 .parquet 미리보기
+except ImportError:
+    pq = None
+try:
+    from markdown_it import MarkdownIt  # 선택 - 있으면 답변을 서버에서 미리 HTML로 렌더링
+except ImportError:
+    MarkdownIt = None
+try:
+    from pygments import highlight as pygments_highlight
+    from pygments.lexers import get_lexer_by_name, TextLexer
+    from pygments.formatters import HtmlFormatter
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments_highlight = None
+try:
+    from latex2mathml.converter import convert as latex_to_mathml  # 없으면 수식만 브라우저 KaTeX로
+except ImportError:
+    latex_to_mathml = None
 import httpx  # 웹 검색용
-from urllib.parse import quote_plus
+from urllib.parse import quote_plus, urlparse, parse_qs
+import lxml.html  # python-docx 의존성으로 함께 설치됨
+from html import escape as html_escape
 
 load_dotenv()
-app = FastAPI()
+
+# 시작/종료 시 실행할 코루틴 함수 (아래 각 섹션에서 등록)
+startup_hooks = []
+shutdown_hooks = []
+
+@asynccontextmanager
+async def lifespan(app):
+    for hook in startup_hooks:
+        await hook()
+    yield
+    for hook in shutdown_hooks:
+        await hook()
+
+# `python app.py`로 띄우면 spawn된 자식 프로세스(PDF 추출 풀, uvicorn 워커)가 이 파일을 "__mp_main__"으로 다시 실행함
+# → 그때는 함수/상수 정의만 하고 저장소 로드, 폴더 생성/정리, API 클라이언트 같은 서버 준비는 건너뜀
+SERVER_PROCESS = __name__ != "__mp_main__"
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
-client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), timeout=180.0, max_retries=3)
+# 재시도는 SDK 대신 RateGovernor가 대기열에서 처리 (retry-after, 서킷 브레이커)
+client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), timeout=180.0, max_retries=0) if SERVER_PROCESS else None
 
 DATA_DIR = "data"
 CHATS_FILE = os.path.join(DATA_DIR, "chats.json")
 SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
+DOCS_DIR = os.path.join(DATA_DIR, "docs")
+UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
+PDF_PAGES_DIR = os.path.join(DATA_DIR, "pdf_pages")
 
-os.makedirs(DATA_DIR, exist_ok=True)
+if SERVER_PROCESS:
+    os.makedirs(DATA_DIR, exist_ok=True)
+    for _dir in (DOCS_DIR, UPLOADS_DIR, PDF_PAGES_DIR):
+        os.makedirs(_dir, exist_ok=True)
 
 chats: Dict[str, dict] = {}
 settings: dict = {"theme": "dark", "fontSize": "medium"}
 
-def load_data():
-    global chats, settings
+# ============ 메시지 레코드 ============
+# 메시지는 dict 대신 슬롯 객체로 들고 있음 - 키 문자열/ISO 시각 문자열 중복 없이, 같은 본문을 두 번 들지 않게
+MESSAGE_COMPRESS_MIN = 2048   # 이보다 긴 본문은 zlib으로 압축해서 보관 (읽을 때만 풂)
+
+class Message:
+    __slots__ = ("role", "time", "usage", "model", "_content", "_display")
+
+    def __init__(self, role, content, display=None, ts=None, usage=None, model=None):
+        self.role = sys.intern(role)
+        self.time = int(ts if ts is not None else time.time())
+        self.usage = usage
+        self.model = sys.intern(model) if model else None
+        self._content = self._pack(content)
+        self._display = None if display is None or display == content else self._pack(display)
+
+    @staticmethod
+    def _pack(text):
+        if len(text) >= MESSAGE_COMPRESS_MIN:
+            packed = zlib.compress(text.encode('utf-8'))
+            if len(packed) < len(text):
+                return packed
+        return text
+
+    @staticmethod
+    def _unpack(value):
+        return zlib.decompress(value).decode('utf-8') if isinstance(value, bytes) else value
+
+    @property
+    def content(self):
+        return self._unpack(self._content)
+
+    @property
+    def display(self):
+        """화면 표시용 - 따로 저장하지 않았으면 content와 같음"""
+        return self.content if self._display is None else self._unpack(self._display)
+
+    @property
+    def day(self):
+        return time.strftime("%Y-%m-%d", time.localtime(self.time))
+
+    def iso_time(self):
+        return datetime.fromtimestamp(self.time).isoformat()
+
+    def to_dict(self, full=True):
+        """API/내보내기용 dict (full=False면 저장용 - display가 content와 같으면 생략)"""
+        data = {"role": self.role, "content": self.content, "time": self.iso_time()}
+        if full or self._display is not None:
+            data["display"] = self.display
+        if self.usage:
+            data["usage"] = self.usage
+        if self.model:
+            data["model"] = self.model
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        ts = data.get("time")
+        if isinstance(ts, str):
+            try: ts = datetime.fromisoformat(ts).timestamp()
+            except ValueError: ts = None
+        return cls(data["role"], data["content"], data.get("display"), ts, data.get("usage"), data.get("model"))
+
+def _fork_chain(chat):
+    """분기 채팅부터 뿌리까지 [(채팅, 부모에게서 가져오는 upto)] - 재귀 대신 반복, 고리가 있으면 거기서 끊음"""
+    chain, seen = [], set()
+    while True:
+        seen.add(id(chat))
+        parent = chat.get("parent")
+        up = chats.get(parent["chat"]) if parent else None
+        if up is None or id(up) in seen:
+            chain.append((chat, None))
+            return chain
+        chain.append((chat, parent["upto"]))
+        chat = up
+
+def _chain_lengths(chain):
+    """체인 각 채팅의 전체 기록 길이 (뿌리부터 계산, chain과 같은 순서)"""
+    lengths = [0] * len(chain)
+    for i in range(len(chain) - 1, -1, -1):
+        node, upto = chain[i]
+        inherited = 0 if upto is None else min(lengths[i + 1], upto)
+        lengths[i] = inherited + len(node.get("messages", []))
+    return lengths
+
+def chat_length(chat):
+    """전체 기록 메시지 수 - 목록용으로 기록을 만들지 않고 셈"""
+    if not chat.get("parent"):
+        return len(chat.get("messages", []))
+    return _chain_lengths(_fork_chain(chat))[0]
+
+def chat_history(chat):
+    """분기 채팅은 부모의 앞부분(upto개)을 복사하지 않고 참조 - 부모 기록 + 자기 메시지 (조각을 모아 한 번만 합침)"""
+    own = chat.get("messages", [])
+    if not chat.get("parent"):
+        return own
+    chain = _fork_chain(chat)
+    lengths = _chain_lengths(chain)
+    need, parts = lengths[0], []
+    for i, (node, upto) in enumerate(chain):
+        inherited = 0 if upto is None else min(lengths[i + 1], upto)
+        parts.append(node.get("messages", [])[:max(need - inherited, 0)])
+        need = min(need, inherited)
+        if not need:
+            break
+    return [m for part in reversed(parts) for m in part]
+
+def docs_before(chat, at):
+    """at번째 메시지 전에 붙은 문서만 - 분기/다시 생성이 그 시점 이후에 올린 문서를 물려받지 않게 (at 없는 예전 참조는 처음부터로 봄)"""
+    return [ref for ref in chat.get("docs", []) if ref.get("at", 0) < at]
+
+def chat_to_dict(chat):
+    """/chat/{id} 응답 - 예전 dict 형식 그대로 (분기는 부모 기록까지 펼쳐서)"""
+    return {**chat, "messages": [m.to_dict() for m in chat_history(chat)]}
+
+def api_history(chat):
+    """API 호출/토큰 추정용 메시지 목록 (display 제외)"""
+    return [{"role": m.role, "content": m.content} for m in chat_history(chat)]
+
+def _store_json_default(obj):
+    if isinstance(obj, Message):
+        return obj.to_dict(full=False)
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+# ============ 답변 HTML 사전 렌더링 ============
+# 답변은 저장할 때 서버에서 한 번만 마크다운/수식/코드 하이라이트까지 HTML로 만들어 두고
+# /chat/{id}는 그 조각을 그대로 내려줌 - 채팅을 다시 열 때 브라우저에서 marked/KaTeX를 돌리지 않음
+# 캐시 키는 본문 해시 + 렌더러 버전 → 렌더링 방식을 바꾸면 RENDERER_VERSION만 올리면 됨
+RENDERER_VERSION = 1
+RENDER_TAG = f"v{RENDERER_VERSION}-{'mathml' if latex_to_mathml else 'katex'}"
+RENDERED_DIR = os.path.join(DATA_DIR, "rendered")
+RENDER_CACHE_SIZE = 256
+
+render_cache: "OrderedDict[str, dict]" = OrderedDict()  # 본문 sha1 -> {"html", "math"}
+render_cache_lock = threading.Lock()  # 이벤트 루프와 렌더링 스레드가 같이 씀
+
+# 수식/코드 구간 - 코드 안의 $나 \[는 수식이 아님
+CODE_SPAN_PATTERN = re.compile(r'^[ \t]*(`{3,}|~{3,}).*?(?:^[ \t]*\1[ \t]*$|\Z)|(`+).+?\2', re.M | re.S)
+MATH_PATTERN = re.compile(r'\$\$(.+?)\$\$|\\\[(.+?)\\\]|\\\((.+?)\\\)|(?<![\\$])\$(?![\s$])([^$\n]+?)(?<![\s\\])\$(?!\d)', re.S)
+CODE_LANG_ICONS = {'python': 'fab fa-python', 'javascript': 'fab fa-js', 'sql': 'fas fa-database', 'bash': 'fas fa-terminal'}
+
+def _render_code(self, tokens, idx, options, env):
+    """코드 블록 - 화면(marked) 렌더러와 같은 code-block 마크업, 하이라이트는 pygments"""
+    token = tokens[idx]
+    lang = token.info.split()[0] if token.info.strip() else ""
+    language = lang or "plaintext"
+    highlighted = html_escape(token.content)
+    if pygments_highlight:
+        try:
+            lexer = get_lexer_by_name(lang) if lang else TextLexer()
+        except ClassNotFound:
+            lexer = TextLexer()
+        highlighted = pygments_highlight(token.content, lexer, HtmlFormatter(nowrap=True))
+    icon = CODE_LANG_ICONS.get(language, 'fas fa-code')
+    return (f'<div class="code-block"><div class="code-header"><span class="code-lang"><i class="{icon}"></i> {html_escape(language)}</span>'
+            f'<button class="copy-btn" onclick="copyCode(this)"><i class="fas fa-copy"></i> 복사</button></div>'
+            f'<pre><code class="hljs pyg">{highlighted}</code></pre></div>')
+
+if MarkdownIt:
+    # marked 설정과 맞춤: GFM 표/취소선, 줄바꿈 = <br>, HTML 통과
+    markdown_renderer = MarkdownIt("commonmark", {"breaks": True, "html": True}).enable(["table", "strikethrough"])
+    markdown_renderer.add_render_rule("fence", _render_code)
+    markdown_renderer.add_render_rule("code_block", _render_code)
+else:
+    markdown_renderer = None
+
+PYGMENTS_CSS = "\n".join(line for line in HtmlFormatter(style="one-dark").get_style_defs(".pyg").splitlines()
+                         if line.startswith(".pyg")) if pygments_highlight else ""  # 전역 pre 규칙 등은 뺌
+
+def _render_math(match, fallback):
+    """수식 하나 → MathML (latex2mathml이 없거나 변환에 실패하면 원문 그대로 두고 브라우저 KaTeX에 맡김)"""
+    display_tex = match.group(1) if match.group(1) is not None else match.group(2)
+    tex = display_tex if display_tex is not None else (match.group(3) if match.group(3) is not None else match.group(4))
+    if latex_to_mathml:
+        try:
+            return latex_to_mathml(tex.strip(), display="block" if display_tex is not None else "inline")
+        except Exception:
+            pass
+    fallback.append(True)
+    return html_escape(match.group(0))
+
+def render_markdown(text):
+    """답변 본문 → {"html", "math"} (math=True면 브라우저에서 KaTeX를 한 번 더 돌려야 함)"""
+    maths = []
+    fallback = []
+
+    def protect(match):
+        maths.append(_render_math(match, fallback))
+        return f"HRMMATH{len(maths) - 1}X"
+
+    # 마크다운이 수식 안의 \, _, * 를 건드리지 않게 코드 밖의 수식만 자리표시자로 바꿔 둠
+    parts = []
+    last = 0
+    for code in CODE_SPAN_PATTERN.finditer(text):
+        parts.append(MATH_PATTERN.sub(protect, text[last:code.start()]))
+        parts.append(code.group(0))
+        last = code.end()
+    parts.append(MATH_PATTERN.sub(protect, text[last:]))
+
+    html = markdown_renderer.render("".join(parts))
+    if maths:
+        html = re.sub(r'HRMMATH(\d+)X', lambda m: maths[int(m.group(1))], html)
+    return {"html": html, "math": bool(fallback)}
+
+def _rendered_path(key):
+    return os.path.join(RENDERED_DIR, RENDER_TAG, f"{key}.json")
+
+def _remember_rendered(key, rendered):
+    with render_cache_lock:
+        render_cache[key] = rendered
+        render_cache.move_to_end(key)
+        while len(render_cache) > RENDER_CACHE_SIZE:
+            render_cache.popitem(last=False)
+
+def cached_render(text):
+    """캐시에 있는 렌더링 결과 (메모리 → 디스크), 없으면 None"""
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    with render_cache_lock:
+        if key in render_cache:
+            render_cache.move_to_end(key)
+            return render_cache[key]
+    try:
+        with open(_rendered_path(key), 'r', encoding='utf-8') as f:
+            rendered = json.load(f)
+    except (OSError, ValueError):
+        return None
+    _remember_rendered(key, rendered)
+    return rendered
+
+def render_message(text):
+    """답변 HTML - 캐시에 없으면 렌더링해서 디스크에 저장 (워커 스레드에서 실행, 렌더러가 없으면 None)"""
+    if not markdown_renderer:
+        return None
+    rendered = cached_render(text)
+    if rendered is not None:
+        return rendered
+    started = time.monotonic()
+    try:
+        rendered = render_markdown(text)
+    except Exception as e:
+        print(f"⚠️ 답변 렌더링 실패: {e}")
+        return None
+    count_metric("render_ms", int((time.monotonic() - started) * 1000))
+    count_metric("render_misses")
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    _remember_rendered(key, rendered)
+    try:
+        write_json_atomic(_rendered_path(key), rendered)
+    except OSError as e:
+        print(f"⚠️ 렌더링 캐시 저장 실패: {e}")
+    return rendered
+
+async def attach_rendered(messages):
+    """/chat/{id} 응답의 답변에 미리 렌더링한 html을 붙임 (캐시에 없던 것만 스레드에서 렌더링)"""
+    if not markdown_renderer:
+        return
+    missing = []
+    for m in messages:
+        if m["role"] != "assistant":
+            continue
+        rendered = cached_render(m["display"])
+        if rendered is None:
+            missing.append(m)
+        else:
+            m.update(rendered)
+    if missing:
+        results = await asyncio.to_thread(lambda: [render_message(m["display"]) for m in missing])
+        for m, rendered in zip(missing, results):
+            if rendered:
+                m.update(rendered)
+
+def _prune_rendered():
+    """렌더러 버전이 바뀌면 예전 버전 캐시 폴더는 지움"""
+    os.makedirs(os.path.join(RENDERED_DIR, RENDER_TAG), exist_ok=True)
+    for name in os.listdir(RENDERED_DIR):
+        if name != RENDER_TAG:
+            shutil.rmtree(os.path.join(RENDERED_DIR, name), ignore_errors=True)
+
+if SERVER_PROCESS:
+    _prune_rendered()
+
+# ============ 공유 저장소 (멀티 워커) ============
+# 워커 여러 개가 같은 data/ 파일을 쓰므로, 변경은 항상 프로세스 간 잠금 안에서
+# "다시 읽기(필요할 때만) → 수정 → 원자적 저장" 순서로 함
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_ID = str(os.getpid())
+LOCK_FILE = os.path.join(DATA_DIR, ".store.lock")
+
+if os.name == 'nt':
+    import msvcrt
+
+    def _lock_file(f, blocking=True):
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:  # LK_LOCK은 약 10초 기다린 뒤 실패 → 계속 대기
+                if not blocking:
+                    return False
+
+    def _unlock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock_file(f, blocking=True):
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _unlock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+_store_rlock = threading.RLock()
+_lock_state = {"depth": 0, "file": None}
+
+def _acquire_store(blocking=True):
+    if not _store_rlock.acquire(blocking):
+        return False
+    if _lock_state["depth"] == 0:
+        f = open(LOCK_FILE, 'a+b')
+        if not _lock_file(f, blocking):
+            f.close()
+            _store_rlock.release()
+            return False
+        _lock_state["file"] = f
+    _lock_state["depth"] += 1
+    return True
+
+def _release_store():
+    _lock_state["depth"] -= 1
+    if _lock_state["depth"] == 0:
+        _unlock_file(_lock_state["file"])
+        _lock_state["file"].close()
+        _lock_state["file"] = None
+    _store_rlock.release()
+
+@contextmanager
+def store_lock():
+    """프로세스 간 저장소 잠금 (같은 프로세스 안에서는 재진입 가능) - 안에서 await 하지 말 것
+    이벤트 루프에서는 store_lock_async를 씀 (여기서는 다른 워커가 풀 때까지 스레드가 멈춤)"""
+    _acquire_store()
+    try:
+        yield
+    finally:
+        _release_store()
+
+@asynccontextmanager
+async def store_lock_async():
+    """이벤트 루프용 store_lock - 다른 워커/스레드가 잡고 있으면 루프를 막지 않고 잠깐씩 쉬며 다시 시도
+    잡은 뒤의 구간은 store_lock과 같음 (안에서 await 하지 말 것, 안쪽 store_lock은 재진입)"""
+    delay = 0.002
+    while not _acquire_store(blocking=False):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.05)
+    try:
+        yield
+    finally:
+        _release_store()
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+def _replace_atomic(path, write):
+    """임시 파일에 쓴 뒤 교체 - 다른 워커가 반쯤 쓴 파일을 읽지 않게 함
+    임시 파일 이름은 쓰기마다 따로 (같은 워커의 여러 스레드가 같은 파일을 동시에 써도 서로의 임시 파일을 옮기지 않게)"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        for attempt in range(10):
+            try:
+                os.replace(tmp, path)
+                return
+            except PermissionError:  # Windows: 다른 프로세스가 읽는 중
+                time.sleep(0.05 * (attempt + 1))
+        os.replace(tmp, path)
+    except BaseException:
+        try: os.unlink(tmp)
+        except OSError: pass
+        raise
+
+def write_json_atomic(path, data, **kwargs):
+    def dump(f):
+        text = io.TextIOWrapper(f, encoding='utf-8')
+        json.dump(data, text, ensure_ascii=False, **kwargs)
+        text.detach()  # flush만 하고 파일은 _replace_atomic이 닫음
+    _replace_atomic(path, dump)
+
+def copy_file_atomic(source, path):
+    """파일 객체 내용을 path로 (write_json_atomic과 같은 방식)"""
+    _replace_atomic(path, lambda f: shutil.copyfileobj(source, f, UPLOAD_CHUNK))
+
+store_stamps: Dict[str, tuple] = {}  # 마지막으로 읽거나 쓴 시점의 (mtime, size)
+
+def load_chats():
+    global chats
+    store_stamps[CHATS_FILE] = _file_stamp(CHATS_FILE)
     if os.path.exists(CHATS_FILE):
         try:
             with open(CHATS_FILE, 'r', encoding='utf-8') as f:
                 chats = json.load(f)
+            for chat in chats.values():
+                chat["messages"] = [Message.from_dict(m) for m in chat["messages"]]
         except: chats = {}
+    rebuild_aggregates()
+
+def load_settings():
+    global settings
+    store_stamps[SETTINGS_FILE] = _file_stamp(SETTINGS_FILE)
     if os.path.exists(SETTINGS_FILE):
         try:
             with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
                 settings = json.load(f)
         except: pass
 
+def load_data():
+    load_chats()
+    load_settings()
+
+def _chat_signature(chat):
+    return (chat.get("updated"), chat["title"], len(chat["messages"])) if chat else None
+
+def refresh_if_stale():
+    """다른 워커가 파일을 바꿨을 때만 다시 읽음 (평소에는 stat 한 번)"""
+    if _file_stamp(CHATS_FILE) != store_stamps.get(CHATS_FILE):
+        before = {k: _chat_signature(v) for k, v in chats.items()}
+        load_chats()
+        for chat_id in set(before) | set(chats):
+            if before.get(chat_id) != _chat_signature(chats.get(chat_id)):
+                mark_changed(chat_id)
+    if _file_stamp(SETTINGS_FILE) != store_stamps.get(SETTINGS_FILE):
+        load_settings()
+
 def save_chats():
-    with open(CHATS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(chats, f, ensure_ascii=False, indent=2)
+    with store_lock():
+        write_json_atomic(CHATS_FILE, chats, indent=2, default=_store_json_default)
+        store_stamps[CHATS_FILE] = _file_stamp(CHATS_FILE)
 
 def save_settings():
-    with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(settings, f, ensure_ascii=False, indent=2)
+    with store_lock():
+        write_json_atomic(SETTINGS_FILE, settings, indent=2)
+        store_stamps[SETTINGS_FILE] = _file_stamp(SETTINGS_FILE)
+
+class SharedStoreMiddleware:
+    """요청마다 다른 워커의 변경을 반영 (ASGI 미들웨어라 SSE 스트리밍에도 영향 없음)"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            refresh_if_stale()
+            count_metric("requests")
+        await self.app(scope, receive, send)
+
+app.add_middleware(SharedStoreMiddleware)
+
+# ============ 메트릭 (워커별로 기록 → /metrics에서 합산) ============
+METRICS_DIR = os.path.join(DATA_DIR, "metrics")
+METRICS_FLUSH_INTERVAL = 5     # 초
+METRICS_STALE_AFTER = 600      # 이보다 오래 갱신 안 된 워커 파일은 합산에서 제외
+if SERVER_PROCESS:
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+metrics = Counter()
+
+def count_metric(name, value=1):
+    metrics[name] += value
+
+def metrics_path(worker_id):
+    return os.path.join(METRICS_DIR, f"{worker_id}.json")
+
+def flush_metrics():
+    write_json_atomic(metrics_path(WORKER_ID), {"worker": WORKER_ID, "updated": time.time(), "metrics": dict(metrics)})
+
+async def _metrics_flusher():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try: flush_metrics()
+        except OSError as e: print(f"메트릭 저장 실패: {e}")
+
+async def _start_metrics():
+    _background_tasks.append(asyncio.create_task(_metrics_flusher()))
+
+async def _stop_metrics():
+    try: os.remove(metrics_path(WORKER_ID))
+    except OSError: pass
+
+_background_tasks = []
+startup_hooks.append(_start_metrics)
+shutdown_hooks.append(_stop_metrics)
+
+def collect_metrics():
+    """모든 워커의 메트릭 - 자기 것은 메모리에서, 다른 워커는 파일에서 읽음"""
+    workers = {WORKER_ID: dict(metrics)}
+    now = time.time()
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith(".json") or name[:-5] == WORKER_ID:
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name), 'r', encoding='utf-8') as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if now - snap.get("updated", 0) <= METRICS_STALE_AFTER:
+            workers[snap["worker"]] = snap["metrics"]
+    total = Counter()
+    for values in workers.values():
+        total.update({k: v for k, v in values.items() if isinstance(v, (int, float))})
+    return {"workers": workers, "total": dict(total)}
+
+# ============ 집계 / 최근 순서 인덱스 ============
+# 채팅이 바뀔 때마다 조금씩 갱신해서 /chats, /stats가 전체를 다시 훑지 않게 함
+recent_index: "OrderedDict[str, None]" = OrderedDict()  # updated 오래된 순 → 최근 순 (끝이 최신)
+stats_totals = {"messages": 0, "input_tokens": 0, "output_tokens": 0}
+chat_usage: Dict[str, dict] = {}   # 채팅별 {"messages", "input_tokens", "output_tokens"}
+daily_stats: Dict[str, dict] = {}  # "YYYY-MM-DD" -> {"messages", "input_tokens", "output_tokens"}
+
+def _usage_tokens(msg):
+    usage = msg.usage or {}
+    return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+
+def track_message(chat_id, msg, sign=1):
+    """메시지 추가(sign=1)/제거(sign=-1)를 집계에 반영"""
+    inp, out = _usage_tokens(msg)
+    per_chat = chat_usage.setdefault(chat_id, {"messages": 0, "input_tokens": 0, "output_tokens": 0})
+    day = daily_stats.setdefault(msg.day, {"messages": 0, "input_tokens": 0, "output_tokens": 0})
+    for bucket in (stats_totals, per_chat, day):
+        bucket["messages"] += sign
+        bucket["input_tokens"] += sign * inp
+        bucket["output_tokens"] += sign * out
+
+def track_touch(chat_id):
+    """채팅을 최근 순서 맨 앞으로 이동"""
+    recent_index[chat_id] = None
+    recent_index.move_to_end(chat_id)
+
+def track_delete(chat_id):
+    """삭제될 채팅의 집계 제거 (chats에서 지우기 전에 호출)"""
+    for msg in chats[chat_id]["messages"]:
+        track_message(chat_id, msg, sign=-1)
+    chat_usage.pop(chat_id, None)
+    recent_index.pop(chat_id, None)
+
+def rebuild_aggregates():
+    """로드 직후 한 번만 전체를 훑어 집계와 인덱스를 만듦"""
+    global chats
+    # chats는 생성 순서를 유지 → 가장 오래된 채팅은 항상 첫 항목
+    chats = dict(sorted(chats.items(), key=lambda x: x[1]["created"]))
+    recent_index.clear()
+    for chat_id, _ in sorted(chats.items(), key=lambda x: x[1].get("updated", x[1]["created"])):
+        recent_index[chat_id] = None
+    stats_totals.update(messages=0, input_tokens=0, output_tokens=0)
+    chat_usage.clear()
+    daily_stats.clear()
+    for chat_id, chat in chats.items():
+        chat_usage[chat_id] = {"messages": 0, "input_tokens": 0, "output_tokens": 0}
+        for msg in chat["messages"]:
+            track_message(chat_id, msg)
+
+def chat_summary(chat_id):
+    """채팅 목록에 쓰는 메타데이터"""
+    chat = chats[chat_id]
+    usage = chat_usage.get(chat_id, {})
+    return {"id": chat_id, "title": chat["title"], "created": chat["created"], "updated": chat.get("updated", chat["created"]),
+            "messageCount": chat_length(chat), "tokens": usage.get("input_tokens", 0) + usage.get("output_tokens", 0)}
+
+# ============ 변경 피드 (리비전 카운터) ============
+# 클라이언트는 /chats 전체를 다시 받지 않고 바뀐 채팅 메타데이터만 받아서 패치함
+store_revision = 0
+change_log: deque = deque(maxlen=2000)  # (revision, chat_id)
+change_event = asyncio.Event()
+CHANGE_HEARTBEAT = 15  # 초
+CHANGE_POLL = 1.0 if WORKERS > 1 else CHANGE_HEARTBEAT  # 멀티 워커면 다른 워커의 변경을 주기적으로 확인
+
+def mark_changed(chat_id):
+    """채팅 변경을 기록하고 대기 중인 피드 구독자를 깨움"""
+    global store_revision, change_event
+    store_revision += 1
+    change_log.append((store_revision, chat_id))
+    change_event.set()
+    change_event = asyncio.Event()
+
+def revision_token():
+    """워커 ID가 붙은 리비전 - 다른 워커로 재연결하면 reset 처리됨"""
+    return f"{WORKER_ID}.{store_revision}"
+
+def parse_revision(token):
+    prefix, _, rev = (token or "").rpartition('.')
+    return int(rev) if prefix == WORKER_ID and rev.isdigit() else None
+
+def changes_since(token):
+    """token 이후 바뀐 채팅 목록 - 로그가 잘렸거나, 다른 워커의 리비전이거나, 현재보다 앞선 리비전(재시작 전 토큰)이면 reset=True (전체 다시 로드 필요)"""
+    revision = parse_revision(token)
+    if revision is None or revision > store_revision or (change_log and revision < change_log[0][0] - 1):
+        return {"revision": revision_token(), "reset": True, "changes": []}
+    changed = OrderedDict()
+    for rev, chat_id in change_log:
+        if rev > revision:
+            changed[chat_id] = None
+            changed.move_to_end(chat_id)
+    return {
+        "revision": revision_token(),
+        "reset": False,
+        "changes": [chat_summary(k) if k in chats else {"id": k, "deleted": True} for k in changed]
+    }
 
-load_data()
+if SERVER_PROCESS:
+    load_data()
 
 SYSTEM_PROMPT = """당신은 정하림님의 개인 AI 어시스턴트입니다.
-당신은 Claude Opus 4 모델입니다 (2025년 5월 버전, Anthropic 최고 성능 모델).
+당신은 Anthropic의 Claude 모델입니다 (질문에 따라 Haiku/Sonnet/Opus 중 하나가 답함).
 
 [하림님 정보] 퀀트 연구자, 논문 리뷰, Python 주력
 
@@ -83,23 +729,315 @@ SYSTEM_PROMPT = """당신은 정하림님의 개인 AI 어시스턴트입니다.
 
 CACHED_SYSTEM = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
 
-def extract_pdf_text(pdf_bytes):
+MODEL = "claude-opus-4-20250514"
+MAX_OUTPUT_TOKENS = 6000
+
+# ============ 모델 라우팅 ============
+# 요청을 로컬에서 가볍게 분류해서 간단한 건 빠른 모델로, 논문/백테스팅 같은 무거운 작업만 Opus로
+MODEL_TIERS = {
+    "fast": {"model": os.getenv("MODEL_FAST", "claude-3-5-haiku-20241022"), "max_tokens": int(os.getenv("MAX_TOKENS_FAST", "1500"))},
+    "standard": {"model": os.getenv("MODEL_STANDARD", "claude-sonnet-4-20250514"), "max_tokens": int(os.getenv("MAX_TOKENS_STANDARD", "4000"))},
+    "heavy": {"model": os.getenv("MODEL_HEAVY", MODEL), "max_tokens": int(os.getenv("MAX_TOKENS_HEAVY", str(MAX_OUTPUT_TOKENS)))},
+}
+ROUTING = os.getenv("ROUTING", "auto")  # auto 또는 fast / standard / heavy 중 하나로 고정
+
+HEAVY_KEYWORDS = ['논문', '백테스트', '백테스팅', '전략', '포트폴리오', '최적화', '증명', '유도', '리뷰', '방법론', '설계', '리팩토링',
+                  'paper', 'backtest', 'portfolio', 'optimiz', 'derive', 'proof', 'architecture']
+# 메시지 전체가 맞장구일 때만 ("네이버 ...", "응용 통계 ...", "okx api ..." 같은 질문은 제외)
+SIMPLE_REPLY = re.compile(r'^(?:(?:고마워|고맙|감사|ㄱㅅ|ㅇㅋ|ㅇㅇ|오케이|알겠|좋아|굿|넵|네|응)(?:요|어|어요|습니다|합니다|해요|네|넵|응)*'
+                          r'|thanks?(?: you)?|thank you|thx|ok|okay)[\s!.~ㅋㅎ?^]*$', re.IGNORECASE)
+CODE_HINT = re.compile(r'```|\b(def|import|class|return|lambda)\b|\w+\.\w+\(|\bdf\[')
+
+def classify_request(message, has_files=False, has_docs=False, searched=False):
+    """(tier, 이유) - 길이/첨부/코드/검색 여부만 보는 로컬 규칙이라 비용 0"""
+    msg = message.strip()
+    lower = msg.lower()
+    if has_files:
+        return "heavy", "첨부 파일 분석"
+    if any(k in lower for k in HEAVY_KEYWORDS):
+        return "heavy", "논문/백테스팅/설계 키워드"
+    if len(msg) > 800 or msg.count('\n') > 20:
+        return "heavy", "긴 질문"
+    if SIMPLE_REPLY.match(msg) and len(msg) <= 30:
+        return "fast", "짧은 후속 메시지"
+    if has_docs:
+        return "standard", "첨부 문서 후속 질문"
+    if searched:
+        return "standard", "웹 검색 결과 요약"
+    if CODE_HINT.search(msg):
+        return ("fast", "한 줄 코드 질문") if len(msg) <= 150 and '\n' not in msg else ("standard", "코드 질문")
+    if len(msg) <= 80:
+        return "fast", "짧은 질문"
+    return "standard", "일반 질문"
+
+def choose_tier(override, message, **signals):
+    """요청별 지정(override) > 서버 고정 설정(ROUTING) > 자동 분류"""
+    if override in MODEL_TIERS:
+        return override, "요청에서 지정"
+    if ROUTING in MODEL_TIERS:
+        return ROUTING, "서버 설정으로 고정"
+    return classify_request(message, **signals)
+
+# ============ 토큰 추정 / 예산 ============
+MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", "150000"))    # 요청 하나의 입력 토큰 상한
+FILE_TOKEN_BUDGET = int(os.getenv("FILE_TOKEN_BUDGET", "40000"))   # 한 요청의 첨부 파일 전체가 나눠 쓰는 토큰
+FILE_MIN_TOKENS = 1000      # 이보다 적게 남으면 파일을 넣지 않고 거절
+EXACT_COUNT_RATIO = 0.8     # 추정치가 상한의 80%를 넘으면 API로 정확히 셈
+
+def estimate_tokens(text: str) -> int:
+    """빠른 로컬 토큰 추정 - 영문/코드 약 3자당 1토큰, 한글 등 비ASCII는 글자당 약 1.3토큰 (약간 크게 잡음)"""
+    if not text:
+        return 0
+    n_chars = len(text)
+    n_bytes = len(text.encode('utf-8'))
+    wide = min(n_chars, (n_bytes - n_chars) // 2)  # 한글은 UTF-8 3바이트
+    return int((n_chars - wide) / 3 + wide * 1.3) + 1
+
+def chars_for_tokens(tokens):
+    """토큰 예산을 다 채우는 데 필요한 최대 글자 수 (estimate_tokens 기준 영문 3자당 1토큰이 가장 많음)"""
+    return max(tokens, 0) * 3
+
+def estimate_prompt_tokens(system, messages) -> int:
+    """시스템 프롬프트 + 메시지 전체 추정 (메시지당 약간의 오버헤드 포함)"""
+    total = sum(estimate_tokens(b["text"]) for b in system)
+    for m in messages:
+        content = m["content"]
+        if isinstance(content, list):
+            content = "".join(b.get("text", "") for b in content)
+        total += estimate_tokens(content) + 4
+    return total
+
+def allocate_budget(sizes, budget, weights=None):
+    """예산 분배 - 가중치(기본은 균등) 비례로 나누되, 필요량보다 많이 받는 파일은 필요량만 주고 남는 몫은 나머지에 재분배"""
+    weights = weights or [1] * len(sizes)
+    alloc = [0] * len(sizes)
+    pending = [i for i in range(len(sizes)) if sizes[i] > 0]
+    remaining = budget
+    while pending and remaining > 0:
+        total_weight = sum(weights[i] for i in pending) or len(pending)
+        satisfied = [i for i in pending if remaining * (weights[i] or 1) / total_weight >= sizes[i]]
+        if not satisfied:
+            for i in pending:
+                alloc[i] = int(remaining * (weights[i] or 1) / total_weight)
+            break
+        for i in satisfied:
+            alloc[i] = sizes[i]
+            remaining -= sizes[i]
+            pending.remove(i)
+    return alloc
+
+def fit_files_to_budget(file_texts, budget, weights=None):
+    """(파일명, 텍스트) 목록을 토큰 예산 안으로 줄여서 프롬프트 조각으로 만듦"""
+    sizes = [estimate_tokens(text) for _, text in file_texts]
+    alloc = allocate_budget(sizes, budget, weights)
+    parts = []
+    for (name, text), size, allowed in zip(file_texts, sizes, alloc):
+        if allowed < size:
+            cut = int(len(text) * allowed / size)
+            text = text[:cut] + f"\n\n[... 토큰 예산 초과로 이후 {len(text) - cut:,}자 생략]"
+        parts.append(f"[파일: {name}]\n{text}")
+    return parts
+
+async def preflight_tokens(model, system, messages):
+    """API 호출 전 입력 토큰 추정 - 상한에 가까울 때만 SDK count_tokens로 정확히 셈"""
+    estimate = estimate_prompt_tokens(system, messages)
+    if estimate < MAX_INPUT_TOKENS * EXACT_COUNT_RATIO:
+        return estimate, "heuristic"
+    try:
+        counted = await client.messages.count_tokens(model=model, system=system, messages=messages)
+        return counted.input_tokens, "api"
+    except Exception as e:
+        print(f"토큰 계산 API 실패, 추정치 사용: {e}")
+        return estimate, "heuristic"
+
+def _open_source(source):
+    """추출기 입력 - bytes면 BytesIO로 감싸고, 파일 객체(스풀 파일)면 처음으로 되감아 그대로 사용"""
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    source.seek(0)
+    return source
+
+def _read_head(source, limit):
+    """텍스트 추출용으로 앞부분 limit 바이트만 읽음"""
+    return _open_source(source).read(limit)
+
+def _decode_text(data, encodings=('utf-8', 'cp949')):
+    """디코딩 - 앞부분만 읽어서 마지막 글자가 잘린 경우도 허용"""
+    for enc in encodings:
+        try:
+            return data.decode(enc)
+        except UnicodeDecodeError as e:
+            if e.start >= len(data) - 3:
+                try: return data[:e.start].decode(enc)
+                except UnicodeDecodeError: pass
+    return None
+
+# ============ PDF 추출 엔진 (페이지 캐시 + 병렬 + 조기 종료) ============
+# PDF는 내용 해시로 data/uploads에 보관하고, 페이지별 텍스트를 data/pdf_pages에 캐시
+# → "40~60페이지 봐줘" 같은 요청은 다시 업로드/추출 없이 캐시에서 바로 꺼냄
+PDF_PARALLEL_MIN_PAGES = 40    # 이보다 긴 문서는 여러 프로세스로 나눠 추출
+PDF_BATCH_PAGES = 16           # 프로세스 하나가 한 번에 맡는 페이지 수
+PDF_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+
+_pdf_pool = None
+
+def _get_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is None:
+        # spawn: Windows와 동작을 맞추고, 스레드가 있는 서버 프로세스를 fork하지 않음
+        _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pdf_pool
+
+def _reset_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+# 풀에 넘기는 함수는 pdf_worker에 둠 - app.py 함수를 넘기면 spawn된 프로세스마다 이 모듈 전체를 다시 import해서
+# 채팅 저장소 로드, 폴더 생성, 클라이언트/미들웨어 설정이 프로세스 수만큼 반복됨
+_extract_pdf_pages = extract_pages
+
+async def _stop_pdf_pool():
+    _reset_pdf_pool()
+
+shutdown_hooks.append(_stop_pdf_pool)
+
+def pdf_path(digest):
+    return os.path.join(UPLOADS_DIR, f"{digest}.pdf")
+
+def store_pdf(source, digest=None):
+    """PDF 원본을 내용 해시 이름으로 보관하고 해시 반환"""
+    f = _open_source(source)
+    if digest is None:
+        h = hashlib.sha256()
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK), b""):
+            h.update(chunk)
+        digest = h.hexdigest()
+        f.seek(0)
+    path = pdf_path(digest)
+    if not os.path.exists(path):
+        copy_file_atomic(f, path)
+    return digest
+
+def _load_page_cache(digest):
     try:
-        reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
-        return "\n".join(p.extract_text() or "" for p in reader.pages).strip()
+        with open(os.path.join(PDF_PAGES_DIR, f"{digest}.json"), 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        return cache["count"], {int(k): v for k, v in cache["pages"].items()}
+    except (OSError, ValueError, KeyError):
+        return None, {}
+
+def _save_page_cache(digest, count, pages):
+    write_json_atomic(os.path.join(PDF_PAGES_DIR, f"{digest}.json"), {"count": count, "pages": pages})
+
+def extract_pdf_pages(digest, pages=None, char_budget=None, path=None):
+    """페이지별 텍스트 {페이지 번호(0부터): 텍스트}와 전체 페이지 수
+    pages: 원하는 페이지 번호들 (없으면 앞에서부터 전부)
+    char_budget: 앞에서부터 모은 글자 수가 이만큼 되면 나머지 페이지는 추출하지 않음
+    path: 보관한 원본 대신 이 파일에서 바로 추출 (페이지 캐시도 쓰지 않음 - 일괄 작업용)"""
+    source = path or pdf_path(digest)
+    count, cache = (None, {}) if path else _load_page_cache(digest)
+    if count is None:
+        count = len(PyPDF2.PdfReader(source).pages)
+    wanted = [p for p in (range(count) if pages is None else pages) if 0 <= p < count]
+    
+    def budget_met():
+        if not char_budget:
+            return False
+        total = 0
+        for p in wanted:
+            if p not in cache:
+                return False
+            total += len(cache[p])
+            if total >= char_budget:
+                return True
+        return False
+    
+    missing = [p for p in wanted if p not in cache]
+    extracted = bool(missing)
+    if missing and len(wanted) < PDF_PARALLEL_MIN_PAGES:
+        for start in range(0, len(missing), PDF_BATCH_PAGES):
+            cache.update(_extract_pdf_pages(source, missing[start:start + PDF_BATCH_PAGES]))
+            if budget_met():
+                break
+    elif missing:
+        # 앞쪽 배치부터 PDF_WORKERS개씩 병렬로 돌리고, 한 묶음이 끝날 때마다 예산 확인
+        batches = [missing[i:i + PDF_BATCH_PAGES] for i in range(0, len(missing), PDF_BATCH_PAGES)]
+        for w in range(0, len(batches), PDF_WORKERS):
+            wave = batches[w:w + PDF_WORKERS]
+            try:
+                pool = _get_pdf_pool()
+                futures = [pool.submit(_extract_pdf_pages, source, b) for b in wave]
+            except Exception as e:  # 프로세스 풀을 못 쓰면 이 프로세스에서 순서대로 추출
+                print(f"PDF 병렬 추출 불가, 순차 추출로 전환: {e}")
+                _reset_pdf_pool()
+                futures = [None] * len(wave)
+            for future, batch in zip(futures, wave):
+                try:
+                    cache.update(future.result() if future else _extract_pdf_pages(source, batch))
+                except Exception as e:
+                    if future is not None:
+                        _reset_pdf_pool()
+                        try:
+                            cache.update(_extract_pdf_pages(source, batch))
+                            continue
+                        except Exception as e2:
+                            e = e2
+                    # 배치 전체 실패 → 해당 페이지들만 실패로 표시
+                    cache.update({p: f"[페이지 {p + 1} 추출 실패: {type(e).__name__}]" for p in batch})
+            if budget_met():
+                break
+    if extracted and not path:
+        _save_page_cache(digest, count, cache)
+    return {p: cache[p] for p in wanted if p in cache}, count
+
+def format_pdf_pages(pages):
+    return "\n\n".join(f"[페이지 {p + 1}]\n{text.strip()}" for p, text in sorted(pages.items()) if text.strip())
+
+def extract_pdf_text(source, digest=None, char_budget=None, path=None):
+    """PDF 텍스트 (페이지 표시 포함) - 예산을 채우면 나머지 페이지는 건너뜀
+    path가 있으면 data/uploads에 보관하지 않고 그 파일에서 바로 추출 (일괄 작업 원본은 작업 쪽에서 관리)"""
+    try:
+        if not path:
+            digest = store_pdf(source, digest)
+        pages, _ = extract_pdf_pages(digest, char_budget=char_budget or DOC_CHAR_LIMIT, path=path)
+        return format_pdf_pages(pages)
     except: return ""
 
-def extract_docx_text(docx_bytes):
+PAGE_RANGE_PATTERNS = [
+    r'(\d+)\s*(?:~|-|–|부터|에서)\s*(\d+)\s*(?:페이지|쪽|p\b|page)',
+    r'(?:p|pp|page|pages)\.?\s*(\d+)\s*(?:~|-|–)\s*(\d+)',
+    # 한 페이지는 "3페이지만", "5쪽 내용", "p. 7"처럼 그 페이지를 콕 집을 때만 - "1페이지짜리 요약"은 분량 얘기
+    r'(\d+)\s*(?:페이지|쪽)\s*(?:만|에서|에\s|에는|의|을|를|내용|보여|설명|번역|읽어)',
+    r'(?:페이지|쪽)\s*(\d+)(?!\s*(?:개|장|짜리|분량|이내|이상|이하))\b',
+    r'\b(?:p|pp|page)\.?\s*(\d+)\b(?!\s*(?:개|장|짜리|pages?))',
+]
+MAX_PAGE_RANGE = 60
+
+def parse_page_range(message):
+    """메시지에서 요청한 페이지 범위 (0부터 시작하는 range) - 없으면 None"""
+    for pattern in PAGE_RANGE_PATTERNS:
+        match = re.search(pattern, message, re.IGNORECASE)
+        if match:
+            first = int(match.group(1))
+            last = int(match.group(2)) if match.lastindex and match.lastindex >= 2 else first
+            first, last = min(first, last), max(first, last)
+            if first >= 1:
+                return range(first - 1, min(last, first - 1 + MAX_PAGE_RANGE))
+    return None
+
+def extract_docx_text(source):
     """Word 문서에서 텍스트 추출"""
     try:
-        doc = docx.Document(io.BytesIO(docx_bytes))
+        doc = docx.Document(_open_source(source))
         return "\n".join(p.text for p in doc.paragraphs).strip()
     except: return ""
 
-def extract_xlsx_text(xlsx_bytes):
+def extract_xlsx_text(source):
     """엑셀에서 텍스트 추출"""
     try:
-        wb = openpyxl.load_workbook(io.BytesIO(xlsx_bytes), data_only=True)
+        wb = openpyxl.load_workbook(_open_source(source), data_only=True)
         text = []
         for sheet in wb.worksheets:
             text.append(f"[시트: {sheet.title}]")
@@ -110,10 +1048,10 @@ def extract_xlsx_text(xlsx_bytes):
         return "\n".join(text)
     except: return ""
 
-def extract_pptx_text(pptx_bytes):
+def extract_pptx_text(source):
     """파워포인트에서 텍스트 추출"""
     try:
-        prs = pptx.Presentation(io.BytesIO(pptx_bytes))
+        prs = pptx.Presentation(_open_source(source))
         text = []
         for i, slide in enumerate(prs.slides, 1):
             text.append(f"[슬라이드 {i}]")
@@ -123,45 +1061,763 @@ def extract_pptx_text(pptx_bytes):
         return "\n".join(text)
     except: return ""
 
-def extract_csv_text(csv_bytes):
+def extract_csv_text(source):
     """CSV에서 텍스트 추출"""
     try:
-        content = csv_bytes.decode('utf-8-sig')
-        return content[:50000]
-    except:
-        try:
-            content = csv_bytes.decode('cp949')
-            return content[:50000]
-        except: return ""
+        content = _decode_text(_read_head(source, DOC_CHAR_LIMIT * 3), ('utf-8-sig', 'cp949'))
+        return content[:DOC_CHAR_LIMIT] if content else ""
+    except: return ""
+
+def extract_text_file(source, filename):
+    """일반 텍스트 파일 추출 (UTF-16은 BOM이 있을 때만)"""
+    try:
+        head = _read_head(source, DOC_CHAR_LIMIT * 3)
+        encodings = ('utf-16',) if head[:2] in (b'\xff\xfe', b'\xfe\xff') else ('utf-8', 'cp949')
+        content = _decode_text(head, encodings)
+        return content[:DOC_CHAR_LIMIT] if content else ""
+    except: return ""
+
+NOTEBOOK_OUTPUT_CHARS = 500    # 셀 출력은 앞부분만
+
+def extract_ipynb_text(source):
+    """주피터 노트북 - 셀 순서대로 마크다운/코드 + 텍스트 출력 (이미지 출력은 제외)"""
+    try:
+        nb = json.loads(_decode_text(_read_head(source, DOC_CHAR_LIMIT * 3)) or "{}")
+        text = []
+        for i, cell in enumerate(nb.get("cells", []), 1):
+            body = "".join(cell.get("source", []))
+            if not body.strip():
+                continue
+            text.append(f"[셀 {i}: {cell.get('cell_type', 'code')}]\n{body}")
+            for output in cell.get("outputs", []):
+                out = output.get("text") or output.get("data", {}).get("text/plain") or ""
+                out = "".join(out) if isinstance(out, list) else out
+                if out.strip():
+                    text.append(f"[출력]\n{out[:NOTEBOOK_OUTPUT_CHARS]}")
+        return "\n\n".join(text)[:DOC_CHAR_LIMIT]
+    except: return ""
+
+PARQUET_PREVIEW_ROWS = 50
+
+def extract_parquet_text(source):
+    """Parquet 미리보기 - 스키마 + 전체 행 수 + 앞쪽 몇 행"""
+    try:
+        f = pq.ParquetFile(_open_source(source))
+        text = [f"[스키마] {f.schema_arrow}", f"[행 수] {f.metadata.num_rows:,}"]
+        batch = next(f.iter_batches(batch_size=PARQUET_PREVIEW_ROWS), None)
+        if batch is not None:
+            text.append("\t".join(batch.schema.names))
+            for row in batch.to_pylist():
+                text.append("\t".join("" if v is None else str(v) for v in row.values()))
+        return "\n".join(text)
+    except: return ""
 
-def extract_text_file(file_bytes, filename):
-    """일반 텍스트 파일 추출"""
+# ============ 추출기 레지스트리 (내용 판별 + 품질 검사) ============
+# 확장자가 아니라 앞부분 바이트로 형식을 판별 → 이미지/압축/예전 Office 파일이 텍스트로 디코딩돼 프롬프트에 섞이는 것을 막음
+TEXT_QUALITY_MIN = 0.85      # 출력 가능한 글자 비율이 이보다 낮으면 깨진 추출로 보고 버림
+SNIFF_BYTES = 8192
+
+class UnreadableFile(Exception):
+    pass
+
+EXTRACTORS: Dict[str, callable] = {}     # 형식 -> func(source, filename, digest, **옵션(char_budget, path))
+EXTENSION_KINDS: Dict[str, str] = {}      # 확장자 -> 형식 (매직 바이트가 없는 텍스트 계열만 확장자로 판단)
+
+def register_extractor(kind, func, extensions=()):
+    EXTRACTORS[kind] = func
+    for ext in extensions:
+        EXTENSION_KINDS[ext] = kind
+
+MAGIC_KINDS = [
+    (b"%PDF-", "pdf"), (b"PK\x03\x04", "zip"), (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "ole"), (b"PAR1", "parquet"),
+    (b"\x89PNG", "image"), (b"\xff\xd8\xff", "image"), (b"GIF8", "image"), (b"II*\x00", "image"), (b"MM\x00*", "image"),
+    (b"\x1f\x8b", "archive"), (b"7z\xbc\xaf\x27\x1c", "archive"), (b"Rar!", "archive"), (b"\x7fELF", "binary"),
+]
+ZIP_KINDS = {"word/document.xml": "docx", "xl/workbook.xml": "xlsx", "ppt/presentation.xml": "pptx"}
+# 등록된 추출기가 없는 형식의 거절 사유
+UNREADABLE = {
+    "image": "이미지", "archive": "압축 파일", "zip": "압축 파일", "binary": "바이너리 파일",
+    "ole": "예전 Office 형식(.doc/.xls/.ppt) - 새 형식(.docx/.xlsx/.pptx)으로 저장해서 올려주세요",
+    "parquet": "Parquet - 서버에 pyarrow를 설치하면 미리보기 가능",
+}
+
+def _zip_kind(source):
     try:
-        return file_bytes.decode('utf-8')[:50000]
-    except:
+        names = set(zipfile.ZipFile(_open_source(source)).namelist())
+    except zipfile.BadZipFile:
+        return "binary"
+    return next((kind for marker, kind in ZIP_KINDS.items() if marker in names), "zip")
+
+def sniff_kind(source, filename):
+    """매직 바이트 → (텍스트 계열만) 확장자 → 기본 텍스트"""
+    head = _read_head(source, SNIFF_BYTES)
+    for magic, kind in MAGIC_KINDS:
+        if head.startswith(magic):
+            return _zip_kind(source) if kind == "zip" else kind
+    if head[:4] == b"RIFF" and head[8:12] in (b"WEBP", b"WAVE", b"AVI "):
+        return "image" if head[8:12] == b"WEBP" else "binary"
+    ext = filename.lower().rsplit('.', 1)[-1] if '.' in filename else ''
+    if b"\x00" in head and head[:2] not in (b'\xff\xfe', b'\xfe\xff'):
+        return "binary"  # 텍스트에는 NUL이 없음 (UTF-16 제외)
+    return EXTENSION_KINDS.get(ext, "text")
+
+def text_quality(text, sample=5000):
+    """출력 가능한 글자(공백 포함) 비율 - 앞/가운데/끝 일부만 봄"""
+    if len(text) > sample * 3:
+        mid = len(text) // 2
+        text = text[:sample] + text[mid:mid + sample] + text[-sample:]
+    good = sum(1 for ch in text if (ch.isprintable() or ch.isspace()) and ch != "\ufffd")
+    return good / max(len(text), 1)
+
+def extract_file_content(source, filename, digest=None, **opts):
+    """형식을 판별해서 등록된 추출기로 텍스트 추출 (source: bytes 또는 읽기 가능한 파일 객체, digest: 알고 있으면 sha256)
+    opts: char_budget (이만큼만 쓸 거라면 추출기가 그 뒤는 건너뛰어도 됨), path (원본 파일 경로 - PDF를 따로 보관하지 않음)
+    읽을 수 없는 형식이거나 결과가 깨져 있으면 UnreadableFile"""
+    kind = sniff_kind(source, filename)
+    extractor = EXTRACTORS.get(kind)
+    if extractor is None:
+        count_metric(f"extract_rejected_{kind}")
+        raise UnreadableFile(UNREADABLE.get(kind, f"{kind} 형식"))
+    started = time.perf_counter()
+    text = extractor(source, filename, digest, **opts)
+    count_metric(f"extract_{kind}")
+    count_metric(f"extract_{kind}_ms", int((time.perf_counter() - started) * 1000))
+    if not text and kind == "text" and _read_head(source, 1):
+        count_metric("extract_rejected_binary")
+        raise UnreadableFile("텍스트로 읽을 수 없는 파일")
+    if text:
+        quality = text_quality(text)
+        if quality < TEXT_QUALITY_MIN:
+            count_metric("extract_rejected_quality")
+            raise UnreadableFile(f"추출한 글자 대부분이 깨져 있음 (정상 {quality:.0%})")
+    return text
+
+register_extractor("pdf", lambda source, filename, digest, **opts: extract_pdf_text(source, digest, **opts), ["pdf"])
+register_extractor("docx", lambda source, filename, digest, **opts: extract_docx_text(source), ["docx"])
+register_extractor("xlsx", lambda source, filename, digest, **opts: extract_xlsx_text(source), ["xlsx"])
+register_extractor("pptx", lambda source, filename, digest, **opts: extract_pptx_text(source), ["pptx"])
+register_extractor("csv", lambda source, filename, digest, **opts: extract_csv_text(source), ["csv", "tsv"])
+register_extractor("ipynb", lambda source, filename, digest, **opts: extract_ipynb_text(source), ["ipynb"])
+register_extractor("text", lambda source, filename, digest, **opts: extract_text_file(source, filename),
+                   ['txt', 'md', 'py', 'js', 'ts', 'java', 'c', 'cpp', 'h', 'json', 'xml', 'html', 'css', 'sql', 'yaml', 'yml', 'ini', 'cfg', 'log', 'sh', 'bat'])
+if pq is not None:
+    register_extractor("parquet", lambda source, filename, digest, **opts: extract_parquet_text(source), ["parquet"])
+
+# ============ 업로드 (해시 + 크기 제한) ============
+# Starlette가 multipart 본문을 이미 자기 SpooledTemporaryFile(upload.file)에 받아 두므로 다시 복사하지 않고
+# 그 파일을 워커 스레드에서 청크 단위로 읽으며 sha256만 계산. 요청 전체 크기는 UploadLimitMiddleware가 받는 중에 끊음
+UPLOAD_CHUNK = 1024 * 1024
+MAX_FILE_BYTES = int(float(os.getenv("MAX_FILE_MB", "50")) * 1024 * 1024)
+MAX_REQUEST_BYTES = int(float(os.getenv("MAX_REQUEST_MB", "200")) * 1024 * 1024)
+MAX_BODY_BYTES = MAX_REQUEST_BYTES + 1024 * 1024   # multipart 경계/폼 필드 여유분
+EXTRACT_CACHE_SIZE = 32          # 같은 파일을 다시 올리면 추출 생략
+
+extract_cache: "OrderedDict[tuple, str]" = OrderedDict()  # (sha256, 확장자, 글자 예산) -> 텍스트
+extract_cache_lock = threading.Lock()  # 여러 추출 스레드가 같이 씀
+
+class UploadTooLarge(Exception):
+    pass
+
+def _mb(n):
+    return f"{n / 1024 / 1024:g}MB"
+
+def _hash_upload_file(f, filename, remaining):
+    """업로드 파일을 처음부터 읽으며 sha256 + 크기 (한도를 넘는 순간 중단)"""
+    digest = hashlib.sha256()
+    size = 0
+    f.seek(0)
+    for chunk in iter(lambda: f.read(UPLOAD_CHUNK), b""):
+        size += len(chunk)
+        if size > MAX_FILE_BYTES:
+            raise UploadTooLarge(f"{filename}: 파일당 최대 {_mb(MAX_FILE_BYTES)}까지 올릴 수 있어요.")
+        if size > remaining:
+            raise UploadTooLarge(f"첨부 파일 합계는 요청당 최대 {_mb(MAX_REQUEST_BYTES)}까지예요.")
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest(), size
+
+async def hash_upload(upload, remaining):
+    """UploadFile의 스풀 파일을 그대로 씀 - (파일, sha256, 크기), 파일은 호출한 쪽에서 닫음"""
+    if upload.size is not None and upload.size > MAX_FILE_BYTES:
+        raise UploadTooLarge(f"{upload.filename}: 파일당 최대 {_mb(MAX_FILE_BYTES)}까지 올릴 수 있어요.")
+    if upload.size is not None and upload.size > remaining:
+        raise UploadTooLarge(f"첨부 파일 합계는 요청당 최대 {_mb(MAX_REQUEST_BYTES)}까지예요.")
+    digest, size = await asyncio.to_thread(_hash_upload_file, upload.file, upload.filename, remaining)
+    return upload.file, digest, size
+
+def extract_cached(source, filename, digest, char_budget=None, path=None):
+    """내용 해시를 키로 추출 결과 캐시 (워커 스레드에서 실행) - 글자 예산이 다르면 따로 캐시"""
+    key = (digest, filename.lower().rsplit('.', 1)[-1] if '.' in filename else '', char_budget)
+    with extract_cache_lock:
+        if key in extract_cache:
+            extract_cache.move_to_end(key)
+            return extract_cache[key]
+    text = extract_file_content(source, filename, digest, char_budget=char_budget, path=path)
+    with extract_cache_lock:
+        extract_cache[key] = text
+        if len(extract_cache) > EXTRACT_CACHE_SIZE:
+            extract_cache.popitem(last=False)
+    return text
+
+class UploadLimitMiddleware:
+    """요청 본문이 한도를 넘으면 413 - Content-Length가 있으면 읽기 전에, 없으면(chunked) 받는 도중에 끊음"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        length = dict(scope["headers"]).get(b"content-length")
+        if length and length.isdigit() and int(length) > MAX_BODY_BYTES:
+            await self._reject(scope, receive, send)
+            return
+        received = 0
+        started = False
+        rejected = False
+
+        async def limited_receive():
+            # 한도를 넘는 순간 413을 먼저 보내고, 앱에는 연결이 끊긴 것처럼 알림 (앱이 이후에 보내는 응답은 버림)
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_BODY_BYTES and not started:
+                    rejected = True
+                    await self._reject(scope, receive, send)
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def tracked_send(message):
+            nonlocal started
+            if rejected:
+                return
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        await self.app(scope, limited_receive, tracked_send)
+
+    @staticmethod
+    async def _reject(scope, receive, send):
+        response = JSONResponse({"response": f"⚠️ 첨부 파일 합계는 요청당 최대 {_mb(MAX_REQUEST_BYTES)}까지예요.", "tokens_used": 0}, status_code=413)
+        await response(scope, receive, send)
+
+app.add_middleware(UploadLimitMiddleware)
+
+# ============ 요청 속도 조절 (토큰 버킷 + 재시도 대기열 + 서킷 브레이커) ============
+# 조직 한도(RPM/TPM)를 워커 수로 나눠 로컬에서 먼저 지키고, 429는 실패 대신 대기열 뒤로 돌려 재시도
+RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", "50"))         # 분당 요청 수
+RATE_LIMIT_TPM = int(os.getenv("RATE_LIMIT_TPM", "40000"))      # 분당 입력 토큰 수
+MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", "4"))    # 워커당 동시 모델 호출 수
+RATE_RETRY_MAX_WAIT = float(os.getenv("RATE_RETRY_MAX_WAIT", "120"))  # 재시도로 기다릴 최대 시간 (브라우저 타임아웃 180초보다 짧게)
+BREAKER_THRESHOLD = 5      # 연속 장애 횟수 → 차단
+BREAKER_COOLDOWN = 30.0    # 차단 유지 시간 (초), 이후 한 요청만 시험 통과
+SERVER_ERROR_RETRIES = 2   # 연결 오류/5xx 재시도 횟수
+
+class CircuitOpenError(Exception):
+    """업스트림 장애로 차단 중 - 바로 실패시켜 부하를 줄임"""
+    def __init__(self, retry_in):
+        super().__init__(f"circuit open ({retry_in:.0f}s)")
+        self.retry_in = retry_in
+
+class TokenBucket:
+    """분당 한도를 초당 속도로 채우는 토큰 버킷"""
+    def __init__(self, per_minute):
+        self.capacity = max(per_minute, 1)
+        self.rate = self.capacity / 60.0
+        self.level = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)  # 한도보다 큰 요청도 언젠가는 통과
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+    def empty(self):
+        self._refill()
+        self.level = min(self.level, 0.0)
+
+class RateGovernor:
+    """모델 호출 앞단 대기열 - 버스트는 오류 대신 지연으로 바뀜"""
+    def __init__(self, rpm, tpm, concurrency):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.slots = asyncio.Semaphore(concurrency)
+        self.queue = asyncio.Lock()  # 공정한 FIFO 대기열
+        self.waiting = 0
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def _gauges(self):
+        metrics["rate_queue_depth"] = self.waiting
+        metrics["model_in_flight"] = self.in_flight
+
+    def breaker_state(self):
+        if self.failures < BREAKER_THRESHOLD:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until or self.probing else "half_open"
+
+    def _check_breaker(self):
+        """열려 있으면 바로 실패, 반쯤 열려 있으면 이 요청을 시험 요청으로 통과시키고 True"""
+        state = self.breaker_state()
+        if state == "open":
+            raise CircuitOpenError(max(self.open_until - time.monotonic(), 1))
+        if state == "half_open":
+            self.probing = True  # 이 요청 하나만 시험 삼아 통과
+            return True
+        return False
+
+    def _record_success(self):
+        self.failures = 0
+        self.probing = False
+
+    def _record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= BREAKER_THRESHOLD:
+            if self.failures == BREAKER_THRESHOLD:
+                count_metric("breaker_opened")
+                print(f"⚠️ 서킷 브레이커 열림 - {BREAKER_COOLDOWN:.0f}초간 모델 호출 차단")
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+    async def _acquire(self, est_tokens):
+        self.waiting += 1
+        self._gauges()
+        started = time.monotonic()
         try:
-            return file_bytes.decode('cp949')[:50000]
-        except: return ""
+            async with self.queue:
+                while True:
+                    wait = max(self.paused_until - time.monotonic(), self.requests.wait_time(1), self.tokens.wait_time(est_tokens))
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                self.requests.take(1)
+                self.tokens.take(est_tokens)
+        finally:
+            self.waiting -= 1
+            self._gauges()
+        waited = time.monotonic() - started
+        count_metric("rate_wait_ms", int(waited * 1000))
+        count_metric("rate_acquires")
+        return waited
+
+    def _pause(self, seconds):
+        """429를 받으면 모든 대기 요청을 retry-after만큼 멈춤"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.requests.empty()
+
+    async def call(self, est_tokens, **kwargs):
+        """버킷 → 동시성 슬롯 → API 호출, 429/장애는 대기열로 되돌려 재시도
+        반환: (응답, 대기 시간 초)"""
+        deadline = time.monotonic() + RATE_RETRY_MAX_WAIT
+        waited = 0.0
+        server_retries = 0
+        while True:
+            probe = self._check_breaker()
+            try:
+                waited += await self._acquire(est_tokens)
+                try:
+                    async with self.slots:
+                        self.in_flight += 1
+                        self._gauges()
+                        try:
+                            response = await client.messages.create(**kwargs)
+                        finally:
+                            self.in_flight -= 1
+                            self._gauges()
+                except RateLimitError as e:
+                    self.probing = False
+                    retry_after = _retry_after(e)
+                    count_metric("rate_limited")
+                    self._pause(retry_after)
+                    if time.monotonic() + retry_after > deadline:
+                        raise
+                    continue
+                except (APIConnectionError, APIStatusError) as e:
+                    if isinstance(e, APIStatusError) and e.status_code < 500:
+                        self.probing = False
+                        raise
+                    self._record_failure()
+                    if server_retries >= SERVER_ERROR_RETRIES or self.breaker_state() == "open" or time.monotonic() > deadline:
+                        raise
+                    server_retries += 1
+                    await asyncio.sleep(min(2 ** server_retries, max(deadline - time.monotonic(), 0)))
+                    continue
+                self._record_success()
+                # 추정치와 실제 입력 토큰 차이만큼 버킷 보정 (캐시 읽기는 한도에 거의 안 잡힘)
+                self.tokens.give_back(est_tokens - response.usage.input_tokens - (getattr(response.usage, 'cache_creation_input_tokens', 0) or 0))
+                return response, waited
+            except BaseException:
+                # 시험 요청이 취소(연결 끊김)나 예상 밖 오류로 끝나면 성공/실패 기록이 없으니 직접 풀어줌
+                # - 안 그러면 probing이 남아 브레이커가 영영 열린 상태로 보임
+                if probe:
+                    self.probing = False
+                raise
+
+    def snapshot(self):
+        return {
+            "queueDepth": self.waiting,
+            "inFlight": self.in_flight,
+            "breaker": self.breaker_state(),
+            "consecutiveFailures": self.failures,
+            "pausedFor": max(round(self.paused_until - time.monotonic(), 1), 0),
+            "requestBucket": round(self.requests.level, 1),
+            "tokenBucket": round(self.tokens.level),
+        }
 
-def extract_file_content(file_bytes, filename):
-    """파일 형식에 따라 텍스트 추출"""
-    ext = filename.lower().split('.')[-1] if '.' in filename else ''
-    
-    if ext == 'pdf':
-        return extract_pdf_text(file_bytes)
-    elif ext == 'docx':
-        return extract_docx_text(file_bytes)
-    elif ext in ['xlsx', 'xls']:
-        return extract_xlsx_text(file_bytes)
-    elif ext == 'pptx':
-        return extract_pptx_text(file_bytes)
-    elif ext == 'csv':
-        return extract_csv_text(file_bytes)
-    elif ext in ['txt', 'md', 'py', 'js', 'ts', 'java', 'c', 'cpp', 'h', 'json', 'xml', 'html', 'css', 'sql', 'yaml', 'yml', 'ini', 'cfg', 'log', 'sh', 'bat']:
-        return extract_text_file(file_bytes, filename)
+def _retry_after(error, default=5.0):
+    try:
+        return max(float(error.response.headers.get("retry-after", default)), 0.5)
+    except (TypeError, ValueError, AttributeError):
+        return default
+
+governor = RateGovernor(RATE_LIMIT_RPM // max(WORKERS, 1), RATE_LIMIT_TPM // max(WORKERS, 1), MODEL_CONCURRENCY)
+
+# ============ 프롬프트 캐시 워밍 ============
+# 시스템 프롬프트 캐시는 5분 동안 안 쓰면 만료 → 아침 첫 질문이 캐시 생성 비용/지연을 다 냄.
+# 활동 시간대에만 만료 직전마다 1토큰짜리 호출로 캐시를 살려 두고, 그게 본전을 뽑는지 메트릭으로 확인
+CACHE_WARMUP = os.getenv("CACHE_WARMUP", "0") == "1"
+CACHE_WARMUP_HOURS = os.getenv("CACHE_WARMUP_HOURS", "9-23")        # 로컬 시각 기준, "22-2"처럼 자정을 넘겨도 됨
+CACHE_WARMUP_TIERS = [t for t in os.getenv("CACHE_WARMUP_TIERS", "heavy").split(",") if t in MODEL_TIERS]
+CACHE_WARMUP_INTERVAL = 270    # 초 - 캐시 수명(5분)보다 조금 짧게
+CACHE_TTL = 300
+WARMER_TICK = 30
+WARMER_FILE = os.path.join(DATA_DIR, "cache_warmer.json")   # 워커 여럿 중 하나만 워밍 (캐시는 조직 단위로 공유됨)
+# 비용 단위: 기본 입력 토큰 1개 = 1 (캐시 생성 1.25배, 캐시 읽기 0.1배, 출력 5배)
+CACHE_WRITE_COST, CACHE_READ_COST, OUTPUT_COST = 1.25, 0.1, 5.0
+
+warmer_state = {"status": "off", "lastWarm": None, "models": {}}
+
+def active_hours(spec=None, hour=None):
+    """'9-23' 같은 시간대 안인지"""
+    try:
+        start, end = (int(x) for x in (spec or CACHE_WARMUP_HOURS).split("-"))
+    except ValueError:
+        return True
+    hour = datetime.now().hour if hour is None else hour
+    return start <= hour < end if start <= end else (hour >= start or hour < end)
+
+# WARMER_FILE: {"owner", "heartbeat", "lastUse": {모델: 마지막 실제 요청}, "lastWarm": {모델: 마지막 워밍}}
+# 실제 요청 시각은 모든 워커가 같이 기록 → 담당 워커가 다른 워커의 트래픽도 보고 쉬어도 되는지 판단
+def _read_warmer_file():
+    try:
+        with open(WARMER_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def note_model_use(model, usage):
+    """실제 요청 기록 (store_lock 안에서 호출) - 캐시를 읽었는데 직전 실제 요청이 캐시 수명보다 오래전이면
+    → 그사이 워밍 호출 덕분에 산 캐시 (워밍 호출은 여기 기록하지 않음)"""
+    if not CACHE_WARMUP:
+        return
+    now = time.time()
+    with store_lock():
+        holder = _read_warmer_file()
+        uses = holder.setdefault("lastUse", {})
+        previous = uses.get(model, 0)
+        uses[model] = now
+        write_json_atomic(WARMER_FILE, holder)
+    if usage.get("cache_read") and now - previous > CACHE_TTL:
+        count_metric("warm_hit_tokens", usage["cache_read"])
+
+async def claim_warmer():
+    """워밍 담당 워커 선출 - 담당 워커의 갱신이 끊기면 다른 워커가 넘겨받음 (담당이면 파일 내용, 아니면 None)"""
+    async with store_lock_async():
+        holder = _read_warmer_file()
+        if holder.get("owner") not in (None, WORKER_ID) and time.time() - holder.get("heartbeat", 0) < WARMER_TICK * 3:
+            return None
+        holder.update(owner=WORKER_ID, heartbeat=time.time())
+        write_json_atomic(WARMER_FILE, holder)
+    return holder
+
+async def warm_model(model):
+    """시스템 프롬프트 프리픽스만 담은 1토큰 호출"""
+    messages = [{"role": "user", "content": "."}]
+    response, _ = await governor.call(
+        estimate_prompt_tokens(CACHED_SYSTEM, messages), model=model, max_tokens=1, system=CACHED_SYSTEM,
+        messages=messages, extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
+    )
+    read = getattr(response.usage, 'cache_read_input_tokens', 0) or 0
+    create = getattr(response.usage, 'cache_creation_input_tokens', 0) or 0
+    async with store_lock_async():
+        holder = _read_warmer_file()
+        holder.setdefault("lastWarm", {})[model] = time.time()
+        write_json_atomic(WARMER_FILE, holder)
+    count_metric("warm_calls")
+    count_metric("warm_cache_read", read)
+    count_metric("warm_cache_create", create)
+    count_metric("warm_input", response.usage.input_tokens)
+    count_metric("warm_output", response.usage.output_tokens)
+    if not read and not create:
+        # 캐시 최소 길이(Opus/Sonnet 1024, Haiku 2048 토큰) 미만이면 캐시가 아예 안 만들어짐 → 워밍해도 소용없음
+        warmer_state["models"][model] = "prefix_too_short"
+        print(f"⚠️ 캐시 워밍 중단 ({model}): 시스템 프롬프트 약 {response.usage.input_tokens} 토큰 - 캐시 최소 길이 미만")
     else:
-        # 알 수 없는 형식은 텍스트로 시도
-        return extract_text_file(file_bytes, filename)
+        warmer_state["models"][model] = "warm"
+    warmer_state["lastWarm"] = datetime.now().isoformat()
+
+async def _cache_warmer():
+    while True:
+        try:
+            if not active_hours():
+                warmer_state["status"] = "idle"
+            elif (holder := await claim_warmer()) is None:
+                warmer_state["status"] = "standby"
+            else:
+                warmer_state["status"] = "active"
+                for tier in CACHE_WARMUP_TIERS:
+                    model = MODEL_TIERS[tier]["model"]
+                    if warmer_state["models"].get(model) == "prefix_too_short":
+                        continue
+                    # 어느 워커든 실제 요청이나 워밍이 최근에 있었으면 캐시가 살아 있음
+                    last = max(holder.get("lastUse", {}).get(model, 0), holder.get("lastWarm", {}).get(model, 0))
+                    if time.time() - last >= CACHE_WARMUP_INTERVAL:
+                        await warm_model(model)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"캐시 워밍 실패: {e}")
+        await asyncio.sleep(WARMER_TICK)
+
+async def _start_cache_warmer():
+    if CACHE_WARMUP and CACHE_WARMUP_TIERS:
+        _background_tasks.append(asyncio.create_task(_cache_warmer()))
+
+startup_hooks.append(_start_cache_warmer)
+
+def cache_warmer_report(total):
+    """워밍 비용 vs 절약 (기본 입력 토큰 단위) + 채팅 전체 캐시 읽기/생성 비율"""
+    cost = (total.get("warm_cache_create", 0) * CACHE_WRITE_COST + total.get("warm_cache_read", 0) * CACHE_READ_COST
+            + total.get("warm_input", 0) + total.get("warm_output", 0) * OUTPUT_COST)
+    saved = total.get("warm_hit_tokens", 0) * (CACHE_WRITE_COST - CACHE_READ_COST)
+    read, create = total.get("cache_read", 0), total.get("cache_create", 0)
+    return {**warmer_state, "enabled": CACHE_WARMUP, "hours": CACHE_WARMUP_HOURS, "calls": total.get("warm_calls", 0),
+            "costUnits": round(cost, 1), "savedUnits": round(saved, 1), "paysOff": saved >= cost,
+            "chatCacheReadRatio": round(read / (read + create), 3) if read + create else None}
+
+# ============ 문서 검색 (로컬 RAG) ============
+# 첨부 문서는 한 번만 청크로 나눠 BM25 인덱스를 만들고, 매 턴 질문과 관련된 청크만 프롬프트에 넣음
+DOC_CHAR_LIMIT = 2_000_000     # 문서 하나에서 인덱싱할 최대 글자 수
+CHUNK_CHARS = 1500
+CHUNK_OVERLAP = 200
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "8"))
+RAG_WHOLE_DOC_TOKENS = 6000    # 이보다 작은 문서는 검색 없이 통째로 넣음
+DOC_INDEX_CACHE = 16           # 메모리에 들고 있을 인덱스 수
+
+# 한국어 질문으로 영어 논문을 찾을 때 자주 쓰는 섹션 이름
+QUERY_SYNONYMS = {
+    "초록": ["abstract"], "요약": ["abstract", "summary", "conclusion"], "서론": ["introduction"],
+    "방법": ["method", "methodology", "approach"], "방법론": ["method", "methodology", "approach", "model"],
+    "모델": ["model"], "데이터": ["data", "dataset", "sample"], "결과": ["result", "results", "findings"],
+    "실험": ["experiment", "empirical"], "결론": ["conclusion", "conclusions"], "한계": ["limitation", "limitations"],
+    "수식": ["equation"], "가정": ["assumption"], "백테스트": ["backtest", "backtesting"], "성과": ["performance", "return"],
+    "샤프": ["sharpe"], "팩터": ["factor"], "수익률": ["return", "returns"], "변동성": ["volatility"],
+}
+
+def tokenize_for_search(text):
+    """검색용 토큰 - 영문/숫자는 단어, 한글은 조사 차이를 흡수하도록 2글자 조각"""
+    terms = []
+    for word in re.findall(r'[a-z0-9]+|[가-힣]+', text.lower()):
+        if word[0] <= 'z' or len(word) <= 2:
+            terms.append(word)
+        else:
+            terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return terms
+
+def expand_query(query):
+    """질문 토큰 + 한↔영 섹션 동의어"""
+    terms = tokenize_for_search(query)
+    for key, words in QUERY_SYNONYMS.items():
+        if key in query:
+            terms.extend(words)
+    return terms
+
+def chunk_text(text):
+    """문단 경계 기준으로 CHUNK_CHARS 안팎의 청크로 분할 (앞 청크 끝부분을 조금 겹침)"""
+    chunks = []
+    current = ""
+    for para in re.split(r'\n\s*\n|\n(?=\[(?:페이지|슬라이드|시트) )', text):
+        para = para.strip()
+        if not para:
+            continue
+        while len(para) > CHUNK_CHARS:  # 문단 하나가 너무 길면 강제로 자름
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(para[:CHUNK_CHARS])
+            para = para[CHUNK_CHARS - CHUNK_OVERLAP:]
+        if current and len(current) + len(para) + 2 > CHUNK_CHARS:
+            chunks.append(current)
+            current = current[-CHUNK_OVERLAP:] + "\n\n" + para
+        else:
+            current = current + "\n\n" + para if current else para
+    if current:
+        chunks.append(current)
+    return chunks
+
+class BM25Index:
+    """청크 목록에 대한 BM25 역색인 (순수 파이썬, CPU만 사용)"""
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, chunks):
+        self.postings = defaultdict(list)  # term -> [(청크 번호, tf)]
+        self.lengths = []
+        for i, chunk in enumerate(chunks):
+            tf = Counter(tokenize_for_search(chunk))
+            self.lengths.append(sum(tf.values()))
+            for term, freq in tf.items():
+                self.postings[term].append((i, freq))
+        n = len(chunks)
+        self.avgdl = (sum(self.lengths) / n) if n else 1
+        self.idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self.postings.items()}
+
+    def search(self, terms, k):
+        """(점수, 청크 번호) 상위 k개"""
+        scores = defaultdict(float)
+        for term in set(terms):
+            idf = self.idf.get(term)
+            if not idf:
+                continue
+            for i, freq in self.postings[term]:
+                norm = 1 - self.b + self.b * self.lengths[i] / self.avgdl
+                scores[i] += idf * freq * (self.k1 + 1) / (freq + self.k1 * norm)
+        return heapq.nlargest(k, ((score, i) for i, score in scores.items()))
+
+doc_indexes: "OrderedDict[str, tuple]" = OrderedDict()  # doc_id -> (문서, BM25Index)
+
+def doc_path(doc_id):
+    return os.path.join(DOCS_DIR, f"{doc_id}.json")
+
+def add_document(name, text):
+    """추출된 문서를 청크로 나눠 저장하고 doc_id 반환 (같은 내용이면 재사용)"""
+    doc_id = hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+    if not os.path.exists(doc_path(doc_id)):
+        doc = {"name": name, "chars": len(text), "tokens": estimate_tokens(text), "chunks": chunk_text(text)}
+        write_json_atomic(doc_path(doc_id), doc)
+    return doc_id
+
+def load_doc_index(doc_id):
+    """문서와 인덱스를 LRU 캐시에서 가져오거나 새로 만듦"""
+    if doc_id in doc_indexes:
+        doc_indexes.move_to_end(doc_id)
+        return doc_indexes[doc_id]
+    try:
+        with open(doc_path(doc_id), 'r', encoding='utf-8') as f:
+            doc = json.load(f)
+    except (OSError, ValueError):
+        return None
+    doc_indexes[doc_id] = (doc, BM25Index(doc["chunks"]))
+    if len(doc_indexes) > DOC_INDEX_CACHE:
+        doc_indexes.popitem(last=False)
+    return doc_indexes[doc_id]
+
+def spread_chunks(n, k):
+    """질문과 겹치는 단어가 없을 때 문서 전체에서 고르게 k개 선택"""
+    if n <= k:
+        return list(range(n))
+    return sorted(set(round(i * (n - 1) / (k - 1)) for i in range(k))) if k > 1 else [0]
+
+def retrieve_doc_context(doc_refs, question, budget, fallback=True):
+    """채팅에 붙은 문서들에서 질문 관련 청크를 골라 예산 안의 프롬프트 조각으로 만듦
+    fallback=False면 관련 청크가 없을 때 아무것도 넣지 않음 (후속 질문용)"""
+    loaded = [(ref, load_doc_index(ref["id"])) for ref in doc_refs]
+    loaded = [(ref, entry) for ref, entry in loaded if entry]
+    if not loaded:
+        return []
+    terms = expand_query(question)
+    ranked = []  # (점수, 문서 순번, 청크 번호)
+    whole = {}
+    for d, (ref, (doc, index)) in enumerate(loaded):
+        if doc["tokens"] <= RAG_WHOLE_DOC_TOKENS:
+            whole[d] = list(range(len(doc["chunks"])))
+            continue
+        ranked.extend((score, d, i) for score, i in index.search(terms, RAG_TOP_K))
+    picked = defaultdict(list)
+    for score, d, i in heapq.nlargest(RAG_TOP_K, ranked):
+        picked[d].append((i, score))
+    file_texts, weights = [], []
+    for d, (ref, (doc, index)) in enumerate(loaded):
+        if d in whole:
+            if not fallback and not index.search(terms, 1):
+                continue
+            hits = [(i, 1.0) for i in whole[d]]
+        elif d in picked:
+            hits = picked[d]
+        elif fallback:
+            hits = [(i, 0.5) for i in spread_chunks(len(doc["chunks"]), RAG_TOP_K)]
+        else:
+            continue
+        hits.sort()
+        body = "\n\n[...]\n\n".join(doc["chunks"][i] for i, _ in hits)
+        if d not in whole:
+            if d in picked:
+                body = f"(전체 {len(doc['chunks'])}개 구간 중 질문과 관련된 {len(hits)}개 구간)\n\n" + body
+            else:
+                body = f"(질문과 겹치는 구간이 없어 전체 {len(doc['chunks'])}개 구간 중 고르게 뽑은 {len(hits)}개 구간)\n\n" + body
+        file_texts.append((ref["name"], body))
+        weights.append(sum(score for _, score in hits))
+    return fit_files_to_budget(file_texts, budget, weights) if file_texts else []
+
+def release_docs(chat_id):
+    """채팅 삭제 시 다른 채팅이 쓰지 않는 문서 파일 (인덱스, PDF 원본, 페이지 캐시) 정리"""
+    mine = {ref["id"] for ref in chats[chat_id].get("docs", [])}
+    pdfs = {ref["pdf"] for ref in chats[chat_id].get("docs", []) if ref.get("pdf")}
+    if not mine:
+        return
+    for other_id, other in chats.items():
+        if other_id != chat_id:
+            mine -= {ref["id"] for ref in other.get("docs", [])}
+            pdfs -= {ref.get("pdf") for ref in other.get("docs", [])}
+    _remove_doc_files(mine, pdfs)
+
+def _remove_doc_files(doc_ids, digests):
+    for doc_id in doc_ids:
+        doc_indexes.pop(doc_id, None)
+        try: os.remove(doc_path(doc_id))
+        except OSError: pass
+    for digest in digests:
+        for path in (pdf_path(digest), os.path.join(PDF_PAGES_DIR, f"{digest}.json")):
+            try: os.remove(path)
+            except OSError: pass
+
+pending_uploads: Counter = Counter()  # 답변을 기다리는 턴이 쓰는 문서 id / PDF 해시 - 정리 대상에서 제외
+
+def hold_uploads(keys, sign=1):
+    for key in keys:
+        pending_uploads[key] += sign
+        if pending_uploads[key] <= 0:
+            del pending_uploads[key]
+
+async def discard_unused_uploads(doc_ids, digests):
+    """턴이 거절/실패/취소돼 어느 채팅에도 붙지 않은 업로드의 문서 파일 (인덱스, PDF 원본, 페이지 캐시) 정리"""
+    async with store_lock_async():
+        refresh_if_stale()
+        used_ids, used_pdfs = set(), set()
+        for chat in chats.values():
+            for ref in chat.get("docs", []):
+                used_ids.add(ref["id"])
+                used_pdfs.add(ref.get("pdf"))
+        _remove_doc_files({d for d in doc_ids if d not in used_ids and not pending_uploads[d]},
+                          {g for g in digests if g not in used_pdfs and not pending_uploads[g]})
 
 def generate_title(message: str) -> str:
     """첫 메시지로 제목 생성"""
@@ -170,8 +1826,178 @@ def generate_title(message: str) -> str:
         return msg[:37] + "..."
     return msg or "새 채팅"
 
-async def web_search(query: str, num_results: int = 5) -> str:
-    """웹 검색 - 여러 방법 시도"""
+# ============ 딥 검색 (상위 결과 페이지 본문 병렬 수집) ============
+# 스니펫만으로는 "최신", "가격" 질문 답이 얕아서 상위 K개 페이지 본문을 한 번에 병렬로 가져옴
+DEEP_SEARCH = os.getenv("DEEP_SEARCH", "off")              # off / auto (최신·가격류 질문만) / on
+DEEP_SEARCH_PAGES = int(os.getenv("DEEP_SEARCH_PAGES", "3"))   # 본문을 가져올 상위 결과 수
+DEEP_SEARCH_DEADLINE = float(os.getenv("DEEP_SEARCH_DEADLINE", "6"))  # 초 - 이 안에 끝난 페이지만 사용
+DEEP_PAGE_CHARS = 3000           # 페이지 하나에서 넘길 최대 글자 수
+DEEP_PAGE_BYTES = 2 * 1024 * 1024  # 이보다 큰 응답은 앞부분만 읽음
+PAGE_CACHE_TTL = 600             # 초 - 이 안에는 재요청 없이 캐시 사용, 이후엔 ETag/Last-Modified로 재검증
+PAGE_CACHE_SIZE = 256
+PAGE_MAX_REDIRECTS = 5           # 리다이렉트는 직접 따라가면서 매번 주소 확인
+
+page_cache: "OrderedDict[str, dict]" = OrderedDict()  # URL -> {"text", "etag", "modified", "fetched"}
+PAGE_DROP_XPATH = '//script|//style|//noscript|//nav|//header|//footer|//aside|//form|//svg|//iframe|//button'
+PAGE_BLOCK_TAGS = ('p', 'div', 'li', 'br', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article', 'table', 'pre', 'blockquote')
+
+def ddg_target(href):
+    """DuckDuckGo 결과 링크(//duckduckgo.com/l/?uddg=...)에서 실제 URL 추출 - 광고 링크는 버림"""
+    if href.startswith('//'):
+        href = 'https:' + href
+    parsed = urlparse(href)
+    if parsed.netloc.endswith('duckduckgo.com'):
+        target = parse_qs(parsed.query).get('uddg', [''])[0]
+        parsed = urlparse(target)
+        href = target
+    return href if parsed.scheme in ('http', 'https') and parsed.netloc and not parsed.netloc.endswith('duckduckgo.com') else ""
+
+def _html_encoding(data, encoding):
+    """응답 헤더 → <meta charset> → UTF-8 → CP949 순으로 인코딩 결정 (한국 사이트는 헤더/메타가 없는 경우가 많음)"""
+    if not encoding:
+        meta = re.search(rb'<meta[^>]+charset=["\']?([\w-]+)', data[:4096], re.IGNORECASE)
+        encoding = meta.group(1).decode('ascii') if meta else None
+    if not encoding:
+        try:
+            data.decode('utf-8')
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = 'cp949'
+    return encoding
+
+def html_to_text(data, encoding=None):
+    """HTML → 읽을 수 있는 본문 텍스트 (lxml, 본문 영역 우선, 블록마다 줄바꿈)"""
+    try:
+        html = data.decode(_html_encoding(data, encoding), errors='replace')
+        doc = lxml.html.document_fromstring(re.sub(r'^\s*<\?xml[^>]*\?>', '', html))
+    except Exception:
+        return ""
+    for el in doc.xpath(PAGE_DROP_XPATH):
+        el.drop_tree()
+    root = (doc.xpath('//article') or doc.xpath('//main') or doc.xpath('//body') or [doc])[0]
+    for el in root.iter(*PAGE_BLOCK_TAGS):
+        el.tail = "\n" + (el.tail or "")
+    lines, prev = [], None
+    for line in root.text_content().splitlines():
+        line = re.sub(r'\s+', ' ', line).strip()
+        if line and line != prev:
+            lines.append(line)
+            prev = line
+    return "\n".join(lines)[:DEEP_PAGE_CHARS]
+
+async def public_address(url):
+    """http(s)이고 호스트가 공인 IP로만 풀리면 연결할 주소, 아니면 None
+    검색 결과 링크로 사설망/루프백/링크로컬(메타데이터 서버)에 요청하지 않게"""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return None
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80))
+    except (OSError, UnicodeError, ValueError):
+        return None
+    for info in infos:
+        ip = ipaddress.ip_address(info[4][0].split('%', 1)[0])
+        if getattr(ip, "ipv4_mapped", None):
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            return None
+    return infos[0][4][0] if infos else None
+
+def pinned_request(url, ip):
+    """검사한 IP로 바로 연결하는 (URL, 추가 헤더, extensions) - httpx가 DNS를 다시 풀지 않으므로 리바인딩으로 검사를 못 피함
+    Host 헤더와 TLS SNI/인증서 확인은 원래 호스트 이름으로, 연결은 재사용하지 않음 (같은 IP의 다른 호스트와 섞이지 않게)"""
+    u = httpx.URL(url)
+    host = u.raw_host.decode("ascii")
+    headers = {"Host": f"{host}:{u.port}" if u.port else host, "Connection": "close"}
+    return u.copy_with(host=ip), headers, {"sni_hostname": host}
+
+async def fetch_page_text(client, url, headers):
+    """페이지 본문 (URL 캐시 → 조건부 요청 → 새로 받기) - 공인 주소가 아니면 (리다이렉트 포함) 받지 않음"""
+    cached = page_cache.get(url)
+    now = time.time()
+    if cached and now - cached["fetched"] < PAGE_CACHE_TTL:
+        page_cache.move_to_end(url)
+        count_metric("page_cache_hit")
+        return cached["text"]
+    req_headers = dict(headers)
+    if cached and cached.get("etag"):
+        req_headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("modified"):
+        req_headers["If-Modified-Since"] = cached["modified"]
+    target = url
+    for _ in range(PAGE_MAX_REDIRECTS + 1):
+        ip = await public_address(target)
+        if not ip:
+            count_metric("deep_fetch_blocked")
+            return ""
+        pinned, pin_headers, extensions = pinned_request(target, ip)
+        async with client.stream("GET", pinned, headers={**req_headers, **pin_headers}, extensions=extensions, follow_redirects=False) as response:
+            if response.has_redirect_location:
+                target = str(httpx.URL(target).join(response.headers["location"]))
+                continue
+            if response.status_code == 304 and cached:
+                cached["fetched"] = now
+                page_cache.move_to_end(url)
+                count_metric("page_cache_revalidated")
+                return cached["text"]
+            ctype = response.headers.get("content-type", "")
+            if response.status_code != 200 or not ("html" in ctype or "text/plain" in ctype):
+                return ""
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body += chunk
+                if len(body) >= DEEP_PAGE_BYTES:
+                    break
+            etag, modified, encoding = response.headers.get("etag"), response.headers.get("last-modified"), response.charset_encoding
+            break
+    else:
+        return ""  # 리다이렉트가 너무 많음
+    if "html" in ctype:
+        text = await asyncio.to_thread(html_to_text, bytes(body), encoding)
+    else:
+        text = (_decode_text(bytes(body), (encoding or 'utf-8', 'cp949')) or "")[:DEEP_PAGE_CHARS]
+    count_metric("deep_fetch")
+    page_cache[url] = {"text": text, "etag": etag, "modified": modified, "fetched": now}
+    page_cache.move_to_end(url)
+    while len(page_cache) > PAGE_CACHE_SIZE:
+        page_cache.popitem(last=False)
+    return text
+
+async def fetch_pages(client, urls, headers):
+    """URL들을 동시에 가져오되 전체 마감 시간을 넘긴 건 버림 - {url: 본문}"""
+    tasks = {asyncio.create_task(fetch_page_text(client, url, headers)): url for url in urls}
+    if not tasks:
+        return {}
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=DEEP_SEARCH_DEADLINE)
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+    for task in pending:
+        task.cancel()
+    if pending:
+        count_metric("deep_fetch_timeout", len(pending))
+    pages = {}
+    for task in done:
+        if task.exception():
+            print(f"페이지 가져오기 실패 ({tasks[task]}): {task.exception()}")
+        elif task.result():
+            pages[tasks[task]] = task.result()
+    return pages
+
+def wants_deep_search(message, deep=None):
+    """요청 플래그(1/0) > DEEP_SEARCH 설정 (auto면 최신/가격류 질문만)"""
+    if deep in ("1", "true", "on"):
+        return True
+    if deep in ("0", "false", "off"):
+        return False
+    if DEEP_SEARCH == "on":
+        return True
+    return DEEP_SEARCH == "auto" and any(k in message for k in TIME_KEYWORDS + INFO_KEYWORDS)
+
+async def web_search(query: str, num_results: int = 5, deep: bool = False) -> str:
+    """웹 검색 - 여러 방법 시도 (deep이면 상위 결과 페이지 본문도 병렬로 붙임)"""
     try:
         async with httpx.AsyncClient(timeout=15.0, follow_redirects=True) as client:
             headers = {
@@ -211,9 +2037,14 @@ async def web_search(query: str, num_results: int = 5) -> str:
                             if title and snippet:
                                 results.append(f"**{title}**\n{snippet}\n🔗 {url}")
                     else:
-                        for url, title, snippet in result_blocks[:num_results]:
-                            if title.strip() and snippet.strip():
-                                results.append(f"**{title.strip()}**\n{snippet.strip()}")
+                        picked = [(ddg_target(url), title.strip(), snippet.strip()) for url, title, snippet in result_blocks[:num_results]]
+                        picked = [p for p in picked if p[1] and p[2]]
+                        pages = await fetch_pages(client, [url for url, _, _ in picked if url][:DEEP_SEARCH_PAGES], headers) if deep else {}
+                        for url, title, snippet in picked:
+                            if url in pages:
+                                results.append(f"**{title}**\n{snippet}\n🔗 {url}\n\n📄 본문 발췌:\n{pages[url]}")
+                            else:
+                                results.append(f"**{title}**\n{snippet}")
             except Exception as e:
                 print(f"DuckDuckGo HTML 검색 실패: {e}")
             
@@ -273,6 +2104,10 @@ async def web_search(query: str, num_results: int = 5) -> str:
         print(f"웹 검색 전체 실패: {e}")
         return ""
 
+# 시사/최신 정보 키워드
+TIME_KEYWORDS = ['최신', '현재', '요즘', '지금', '오늘', '이번', '2024', '2025', '2026']
+INFO_KEYWORDS = ['뉴스', '소식', '가격', '환율', '주가', '시세', '날씨', '기온', '발표', '출시']
+
 def should_search(message: str) -> tuple[bool, str]:
     """메시지에서 검색 필요 여부와 검색어 추출"""
     import re
@@ -294,49 +2129,291 @@ def should_search(message: str) -> tuple[bool, str]:
                 return True, query
     
     # 시사/최신 정보 키워드
-    time_keywords = ['최신', '현재', '요즘', '지금', '오늘', '이번', '2024', '2025', '2026']
-    info_keywords = ['뉴스', '소식', '가격', '환율', '주가', '시세', '날씨', '기온', '발표', '출시']
-    
-    for keyword in time_keywords + info_keywords:
+    for keyword in TIME_KEYWORDS + INFO_KEYWORDS:
         if keyword in msg:
             return True, msg
     
     return False, ""
 
 
-@app.post("/chat")
-async def chat_endpoint(chat_id: str = Form(...), message: str = Form(default=""), files: List[UploadFile] = File(default=[])):
-    global chats
-    
+# ============ 연결 끊김 처리 ============
+# 브라우저가 탭을 닫거나 180초 타임아웃으로 요청을 끊으면 서버도 그 작업을 멈춤
+ON_DISCONNECT = os.getenv("ON_DISCONNECT", "cancel")  # cancel: 모델 호출/검색 즉시 취소 / background: 끝까지 처리해서 저장
+DISCONNECT_POLL = 0.5   # 초
+
+background_chats = set()  # background 모드에서 응답 받을 사람 없이 마저 도는 작업 (GC 방지용 참조)
+
+async def run_until_disconnect(request, work, files_read=None):
+    """작업이 끝날 때까지 기다리되, 그 전에 클라이언트가 끊기면 ON_DISCONNECT에 따라 취소하거나 놓아줌
+    files_read: 작업이 업로드를 다 읽었다는 표시 - 백그라운드로 넘길 때 그 전에 응답하면 Starlette가 UploadFile을 닫아버림"""
+    try:
+        while True:
+            done, _ = await asyncio.wait({work}, timeout=DISCONNECT_POLL)
+            if done:
+                return work.result()
+            if await request.is_disconnected():
+                break
+    except asyncio.CancelledError:
+        work.cancel()  # 서버 종료 등으로 요청 자체가 취소됨
+        raise
+    count_metric("chat_disconnects")
+    if ON_DISCONNECT == "background":
+        background_chats.add(work)
+        work.add_done_callback(background_chats.discard)
+        if files_read and not files_read.is_set():
+            waiter = asyncio.ensure_future(files_read.wait())
+            await asyncio.wait({work, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+        return JSONResponse({"response": "연결이 끊겨서 답변은 백그라운드에서 마저 만들어 저장해요.", "tokens_used": 0}, status_code=499)
+    work.cancel()
+    try: await work
+    except asyncio.CancelledError: pass
+    return JSONResponse({"response": "⚠️ 연결이 끊겨서 요청을 중단했어요.", "tokens_used": 0}, status_code=499)
+
+def open_chat(chat_id, fork_of=None):
+    """채팅을 가져오거나 새로 만듦 - fork_of=(부모 id, upto)면 부모 앞부분을 공유하는 분기로 (store_lock 안에서 호출)"""
     if chat_id not in chats:
         chats[chat_id] = {"title": "새 채팅", "messages": [], "created": datetime.now().isoformat(), "updated": datetime.now().isoformat()}
+        parent = chats.get(fork_of[0]) if fork_of else None
+        if parent:
+            title = parent["title"]
+            chats[chat_id].update(title=title if title.endswith("(분기)") else f"{title} (분기)",
+                                  parent={"chat": fork_of[0], "upto": fork_of[1]}, docs=docs_before(parent, fork_of[1]))
+        track_touch(chat_id)
+    return chats[chat_id]
+
+def detach_children(chat_id):
+    """지울 채팅을 부모로 둔 분기에 필요한 앞부분만 옮겨 담음 (chats에서 지우기 전에 호출)"""
+    chat = chats[chat_id]
+    own = chat["messages"]
+    link = chat.get("parent") if chat.get("parent", {}).get("chat") in chats else None
+    inherited = chat_length(chat) - len(own)   # 이 채팅이 부모에게서 물려받은 메시지 수
+    for child_id, child in chats.items():
+        if child.get("parent", {}).get("chat") != chat_id:
+            continue
+        upto = child["parent"]["upto"]
+        if link and upto <= inherited:
+            child["parent"] = {"chat": link["chat"], "upto": upto}  # 조부모 앞부분만 쓰면 복사 없이 연결만 바꿈
+            continue
+        moved = own[:upto - inherited]
+        child["messages"] = moved + child["messages"]
+        for msg in moved:
+            track_message(child_id, msg)
+        if link:
+            child["parent"] = {"chat": link["chat"], "upto": inherited}
+        else:
+            del child["parent"]
+        mark_changed(child_id)
+
+async def drop_pending_user_message(chat_id):
+    """API 호출이 실패했을 때 방금 저장한 사용자 메시지를 되돌림"""
+    async with store_lock_async():
+        refresh_if_stale()
+        messages = chats.get(chat_id, {}).get("messages")
+        if messages and messages[-1].role == "user":
+            track_message(chat_id, messages.pop(), sign=-1)
+            save_chats()
+            mark_changed(chat_id)
+
+async def build_doc_context(doc_refs, history, question, strict=False):
+    """이번 턴에 붙일 문서 조각 - 기존 대화 + 질문을 빼고 남는 예산 안에서 (strict면 예산이 모자랄 때 None)"""
+    used = estimate_prompt_tokens(CACHED_SYSTEM, history) + estimate_tokens(question) + 50
+    budget = min(FILE_TOKEN_BUDGET, MAX_INPUT_TOKENS - used)
+    if budget < FILE_MIN_TOKENS:
+        return (None if strict else []), used
+    doc_context = []
+    page_range = parse_page_range(question)
+    pdf_refs = [ref for ref in doc_refs if ref.get("pdf")]
+    if page_range and pdf_refs:
+        # 페이지를 콕 집은 요청은 검색 대신 캐시된 페이지를 그대로 넣음
+        page_texts = []
+        for ref in pdf_refs:
+            try:
+                # 한 파일이 받을 수 있는 최대치(예산 전체)만큼 모이면 범위 뒤쪽 페이지는 추출하지 않음
+                pages, count = await asyncio.to_thread(extract_pdf_pages, ref["pdf"], page_range, chars_for_tokens(budget))
+            except Exception as e:
+                print(f"PDF 페이지 추출 실패 ({ref['name']}): {e}")
+                continue
+            if pages:
+                page_texts.append((f"{ref['name']} ({page_range.start + 1}~{page_range.stop}페이지 / 전체 {count})", format_pdf_pages(pages)))
+        doc_context = fit_files_to_budget(page_texts, budget) if page_texts else []
+    if not doc_context:
+        doc_context = retrieve_doc_context(doc_refs, question, budget, fallback=strict)
+    return doc_context, used
+
+def add_history_breakpoint(api_messages):
+    """이번 턴 바로 앞(마지막으로 저장된 기록 메시지)에 캐시 지점 - 문서 조각이 붙는 이번 턴은 매번 달라서 제외.
+    다음 턴과 같은 지점에서 갈라진 분기도 이 앞부분을 캐시에서 읽음"""
+    if len(api_messages) >= 2:
+        prev = api_messages[-2]
+        prev["content"] = [{"type": "text", "text": prev["content"], "cache_control": {"type": "ephemeral"}}]
+
+def chat_error_response(e):
+    """모델 호출 실패를 사용자에게 보여줄 응답으로"""
+    count_metric("chat_errors")
+    if isinstance(e, CircuitOpenError):
+        message = f"⚠️ API가 불안정해서 잠시 요청을 멈췄어요. {e.retry_in:.0f}초 후 다시 시도해주세요."
+    elif isinstance(e, RateLimitError):
+        message = "⚠️ API 요청 한도 초과. 잠시 후 다시 시도해주세요."
+    elif isinstance(e, APIConnectionError):
+        message = "⚠️ 연결 오류. 인터넷 연결을 확인해주세요."
+    elif isinstance(e, APIStatusError):
+        message = f"⚠️ API 오류: {e.message}"
+    else:
+        print(traceback.format_exc())
+        message = f"⚠️ 오류: {e}"
+    return JSONResponse({"response": message, "tokens_used": 0})
+
+def attach_docs(chat, refs):
+    """채팅에 문서 참조 추가 (이미 붙어 있는 문서는 건너뜀) - 저장소 잠금 안에서 호출
+    at: 문서를 올린 사용자 메시지 위치 (분기할 때 그 전 문서만 물려줌)"""
+    known = {ref["id"] for ref in chat.get("docs", [])}
+    at = max(chat_length(chat) - 1, 0)
+    for ref in refs:
+        if ref["id"] not in known:
+            chat.setdefault("docs", []).append({**ref, "at": at})
+            known.add(ref["id"])
+
+async def complete_turn(chat_id, api_messages, doc_context, route, route_reason, fork_of=None, new_docs=()):
+    """모델 호출 → 답변 저장 → 응답 (fork_of=(부모, upto)면 답변을 저장할 때 분기 채팅을 만듦)
+    new_docs: 이번 턴에 올린 문서 - 답변까지 저장될 때만 채팅에 붙임 (거절/실패한 업로드는 남지 않음)"""
+    if doc_context:
+        api_messages[-1]["content"] = "\n\n".join(doc_context) + "\n\n" + api_messages[-1]["content"]
+    add_history_breakpoint(api_messages)
+    model, max_tokens = MODEL_TIERS[route]["model"], MODEL_TIERS[route]["max_tokens"]
     
+    estimated_tokens, estimate_source = await preflight_tokens(model, CACHED_SYSTEM, api_messages)
+    if estimated_tokens > MAX_INPUT_TOKENS:
+        await drop_pending_user_message(chat_id)
+        return JSONResponse({"response": f"⚠️ 입력이 너무 깁니다 (약 {estimated_tokens:,} 토큰, 한도 {MAX_INPUT_TOKENS:,}). 새 채팅에서 시도해주세요.",
+                             "tokens_used": 0, "estimated_tokens": estimated_tokens, "estimate_source": estimate_source})
+    
+    started = time.monotonic()
+    response, queue_wait = await governor.call(
+        estimated_tokens, model=model, max_tokens=max_tokens, system=CACHED_SYSTEM,
+        messages=api_messages, extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
+    )
+    latency_ms = int((time.monotonic() - started - queue_wait) * 1000)
+    count_metric("model_latency_ms", latency_ms)
+    count_metric(f"route_{route}")
+    count_metric(f"route_{route}_latency_ms", latency_ms)
+    
+    assistant_message = response.content[0].text
+    usage = {
+        "input_tokens": response.usage.input_tokens,
+        "output_tokens": response.usage.output_tokens,
+        "cache_read": getattr(response.usage, 'cache_read_input_tokens', 0) or 0,
+        "cache_create": getattr(response.usage, 'cache_creation_input_tokens', 0) or 0,
+        "estimated_input": estimated_tokens,
+    }
+    count_metric("chat_turns")
+    for key in ("input_tokens", "output_tokens", "cache_read", "cache_create"):
+        count_metric(key, usage[key])
+    rendered = await asyncio.to_thread(render_message, assistant_message) or {}  # 저장할 때 한 번만 HTML로
+    
+    async with store_lock_async():
+        note_model_use(model, usage)
+        refresh_if_stale()
+        chat = open_chat(chat_id, fork_of)  # 응답을 기다리는 동안 다른 탭에서 지웠으면 다시 만듦
+        attach_docs(chat, new_docs)
+        assistant_msg = Message("assistant", assistant_message, usage=usage, model=model)
+        chat["messages"].append(assistant_msg)
+        track_message(chat_id, assistant_msg)
+        save_chats()
+        title = chat["title"]
+    mark_changed(chat_id)
+    
+    return JSONResponse({
+        "chat_id": chat_id,
+        "response": assistant_message,
+        "tokens_used": response.usage.input_tokens + response.usage.output_tokens,
+        "title": title,
+        "cache_read": usage["cache_read"],
+        "cache_create": usage["cache_create"],
+        "estimated_tokens": estimated_tokens,
+        "estimate_source": estimate_source,
+        "input_tokens": usage["input_tokens"] + usage["cache_read"] + usage["cache_create"],
+        "queue_wait_ms": int(queue_wait * 1000),
+        "model": model,
+        "tier": route,
+        "route_reason": route_reason,
+        "latency_ms": latency_ms,
+        **rendered
+    })
+
+async def run_chat(chat_id, message, files, tier, deep, files_read=None):
+    """채팅 한 턴 처리 (chat_endpoint가 태스크로 돌리며 연결 끊김을 감시, 업로드를 다 읽으면 files_read를 set)"""
+    new_docs = []
+    uploaded = []  # 이번 턴에 받은 파일 해시 (PDF면 data/uploads에 보관됨)
     try:
         user_message = message.strip()
-        file_contents = []
+        file_texts = []
         file_names = []
         
-        for file in files:
-            if file.filename:
-                try:
-                    file_bytes = await file.read()
-                    file_text = extract_file_content(file_bytes, file.filename)
-                    if file_text:
-                        file_contents.append(f"[파일: {file.filename}]\n{file_text[:25000]}")
-                        file_names.append(file.filename)
-                except: pass
+        file_digests = []
+        skipped = []  # 읽을 수 없어 뺀 파일 (이름 + 사유)
+        remaining = MAX_REQUEST_BYTES
+        try:
+            for file in files:
+                if file.filename:
+                    try:
+                        spool, digest, size = await hash_upload(file, remaining)
+                    except UploadTooLarge as e:
+                        return JSONResponse({"response": f"⚠️ {e}", "tokens_used": 0}, status_code=413)
+                    remaining -= size
+                    uploaded.append(digest)
+                    hold_uploads([digest])
+                    try:
+                        with spool:
+                            file_text = await asyncio.to_thread(extract_cached, spool, file.filename, digest)
+                            if file_text and file.filename.lower().endswith('.pdf'):
+                                await asyncio.to_thread(store_pdf, spool, digest)  # 추출 캐시에서 나왔으면 원본이 지워졌을 수 있음
+                        if file_text:
+                            file_texts.append((file.filename, file_text))
+                            file_names.append(file.filename)
+                            file_digests.append(digest)
+                    except UnreadableFile as e:
+                        skipped.append(f"{file.filename} ({e})")
+                    except: pass
+        finally:
+            if files_read:
+                files_read.set()  # 여기부터는 UploadFile을 안 씀 → 요청이 끝나 파일이 닫혀도 됨
+        
+        if not file_texts and not user_message:
+            if skipped:
+                return JSONResponse({"response": f"⚠️ 읽을 수 없는 파일이에요: {', '.join(skipped)}", "tokens_used": 0})
+            return JSONResponse({"response": "메시지를 입력해주세요.", "tokens_used": 0})
+        
+        # 문서 파일은 내용 해시로 저장되므로 잠금 밖에서 미리 만들어 둠 (턴이 실패하면 finally에서 정리)
+        for (name, text), digest in zip(file_texts, file_digests):
+            ref = {"id": add_document(name, text), "name": name}
+            if name.lower().endswith('.pdf'):
+                ref["pdf"] = digest
+            new_docs.append(ref)
+            hold_uploads([ref["id"]])
+        existing = chats.get(chat_id, {})
+        doc_refs = list(existing.get("docs", []))
+        doc_refs += [ref for ref in new_docs if ref["id"] not in {r["id"] for r in doc_refs}]
+        
+        # 문서 본문은 대화 기록에 넣지 않고, 이번 턴에 필요한 청크만 API 호출 때 붙임
+        doc_context = []
+        if doc_refs:
+            doc_context, used = await build_doc_context(doc_refs, api_history(existing), user_message or " ".join(file_names), strict=bool(file_texts))
+            if doc_context is None:
+                return JSONResponse({"response": "⚠️ 대화가 너무 길어서 파일을 더 넣을 수 없어요. 새 채팅에서 시도해주세요.", "tokens_used": 0, "estimated_tokens": used})
         
-        if file_contents:
-            final_content = "\n\n".join(file_contents) + f"\n\n질문: {user_message or '위 문서를 분석해주세요.'}"
+        searched = False
+        if file_texts:
+            final_content = f"[첨부 파일: {', '.join(file_names)}]\n\n질문: {user_message or '위 문서를 분석해주세요.'}"
             display_content = user_message + (f" 📎 {', '.join(file_names)}" if user_message else f"📎 {', '.join(file_names)}")
-        elif user_message:
+        else:
             final_content = user_message
             display_content = user_message
             
             # 웹 검색 필요 여부 확인
             need_search, search_query = should_search(user_message)
             if need_search and search_query:
-                search_results = await web_search(search_query)
+                search_results = await web_search(search_query, deep=wants_deep_search(user_message, deep))
                 if search_results:
                     final_content = f"""[🔍 웹 검색 결과: "{search_query}"]
 
@@ -347,141 +2424,758 @@ async def chat_endpoint(chat_id: str = Form(...), message: str = Form(default=""
 
 질문: {user_message}"""
                     display_content = f"🔍 {user_message}"
-        else:
-            return JSONResponse({"response": "메시지를 입력해주세요.", "tokens_used": 0})
-        
-        # 메시지 저장 (표시용과 API용 분리)
-        chats[chat_id]["messages"].append({"role": "user", "content": final_content, "display": display_content, "time": datetime.now().isoformat()})
-        chats[chat_id]["updated"] = datetime.now().isoformat()
+                    searched = True
         
-        # 첫 메시지면 제목 생성
-        if len(chats[chat_id]["messages"]) == 1:
-            chats[chat_id]["title"] = generate_title(user_message or file_names[0] if file_names else "PDF 분석")
+        if skipped:
+            final_content += f"\n\n[읽을 수 없어 제외한 파일: {', '.join(skipped)}]"
         
-        # API 호출용 메시지 (display 제외)
-        api_messages = [{"role": m["role"], "content": m["content"]} for m in chats[chat_id]["messages"]]
+        route, route_reason = choose_tier(tier, user_message, has_files=bool(file_texts), has_docs=bool(doc_context), searched=searched)
         
-        response = client.messages.create(
-            model="claude-opus-4-20250514", max_tokens=6000, system=CACHED_SYSTEM,
-            messages=api_messages, extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
-        )
-        
-        assistant_message = response.content[0].text
-        chats[chat_id]["messages"].append({"role": "assistant", "content": assistant_message, "display": assistant_message, "time": datetime.now().isoformat()})
-        save_chats()
+        # 메시지 저장 (표시용과 API용 분리) - 모델 응답을 기다리는 동안 다른 워커가 볼 수 있게 바로 저장
+        async with store_lock_async():
+            refresh_if_stale()
+            chat = open_chat(chat_id)
+            user_msg = Message("user", final_content, display_content)
+            chat["messages"].append(user_msg)
+            chat["updated"] = datetime.now().isoformat()
+            track_message(chat_id, user_msg)
+            track_touch(chat_id)
+            
+            # 첫 메시지면 제목 생성
+            if len(chat["messages"]) == 1 and not chat.get("parent"):
+                chat["title"] = generate_title(user_message or file_names[0] if file_names else "PDF 분석")
+            save_chats()
+            
+            # API 호출용 메시지 (display 제외)
+            api_messages = api_history(chat)
+        mark_changed(chat_id)
         
-        return JSONResponse({
-            "response": assistant_message,
-            "tokens_used": response.usage.input_tokens + response.usage.output_tokens,
-            "title": chats[chat_id]["title"],
-            "cache_read": getattr(response.usage, 'cache_read_input_tokens', 0),
-            "cache_create": getattr(response.usage, 'cache_creation_input_tokens', 0)
-        })
+        return await complete_turn(chat_id, api_messages, doc_context, route, route_reason, new_docs=new_docs)
         
-    except RateLimitError:
-        if chats[chat_id]["messages"] and chats[chat_id]["messages"][-1]["role"] == "user":
-            chats[chat_id]["messages"].pop()
-        return JSONResponse({"response": "⚠️ API 요청 한도 초과. 잠시 후 다시 시도해주세요.", "tokens_used": 0})
-    except APIConnectionError:
-        if chats[chat_id]["messages"] and chats[chat_id]["messages"][-1]["role"] == "user":
-            chats[chat_id]["messages"].pop()
-        return JSONResponse({"response": "⚠️ 연결 오류. 인터넷 연결을 확인해주세요.", "tokens_used": 0})
-    except APIStatusError as e:
-        if chats[chat_id]["messages"] and chats[chat_id]["messages"][-1]["role"] == "user":
-            chats[chat_id]["messages"].pop()
-        return JSONResponse({"response": f"⚠️ API 오류: {e.message}", "tokens_used": 0})
+    except asyncio.CancelledError:
+        # 클라이언트가 떠나서 취소됨 - 진행 중이던 API 요청/검색은 여기서 이미 끊겼고, 사용자 메시지도 되돌림
+        count_metric("chat_cancelled")
+        await drop_pending_user_message(chat_id)
+        raise
     except Exception as e:
-        if chats[chat_id]["messages"] and chats[chat_id]["messages"][-1]["role"] == "user":
-            chats[chat_id]["messages"].pop()
-        print(traceback.format_exc())
-        return JSONResponse({"response": f"⚠️ 오류: {e}", "tokens_used": 0})
+        await drop_pending_user_message(chat_id)
+        return chat_error_response(e)
+    finally:
+        if uploaded:
+            doc_ids = [ref["id"] for ref in new_docs]
+            hold_uploads(uploaded + doc_ids, sign=-1)
+            await discard_unused_uploads(doc_ids, uploaded)
+
+@app.post("/chat")
+async def chat_endpoint(request: Request, chat_id: str = Form(...), message: str = Form(default=""), files: List[UploadFile] = File(default=[]), tier: str = Form(default="auto"), deep: str = Form(default="")):
+    files_read = asyncio.Event()
+    work = asyncio.create_task(run_chat(chat_id, message, files, tier, deep, files_read))
+    return await run_until_disconnect(request, work, files_read)
+
+async def run_regenerate(chat_id, at, tier):
+    """at번째 답변을 다시 생성 - 원래 채팅은 그대로 두고, 앞부분을 공유하는 새 분기에 저장 (실패하면 분기도 안 생김)"""
+    try:
+        source = chats.get(chat_id)
+        history = chat_history(source) if source else []
+        if not 0 < at <= len(history) or history[at - 1].role != "user":
+            return JSONResponse({"response": "⚠️ 다시 생성할 수 없는 위치예요.", "tokens_used": 0}, status_code=400)
+        question = history[at - 1].display
+        api_messages = [{"role": m.role, "content": m.content} for m in history[:at]]
+        doc_context = []
+        doc_refs = docs_before(source, at)
+        if doc_refs:
+            doc_context, _ = await build_doc_context(doc_refs, api_messages[:-1], question)
+        route, route_reason = choose_tier(tier, question, has_docs=bool(doc_context))
+        fork_id = f"{int(time.time() * 1000):x}{os.urandom(4).hex()}"
+        return await complete_turn(fork_id, api_messages, doc_context, route, route_reason, fork_of=(chat_id, at))
+    except asyncio.CancelledError:
+        count_metric("chat_cancelled")
+        raise
+    except Exception as e:
+        return chat_error_response(e)
+
+@app.post("/chat/{chat_id}/regenerate")
+async def regenerate_chat(request: Request, chat_id: str, at: int = Form(...), tier: str = Form(default="auto")):
+    """at번째 메시지(답변) 자리에서 분기해서 답변을 새로 받음 - 응답의 chat_id가 새 분기"""
+    work = asyncio.create_task(run_regenerate(chat_id, at, tier))
+    return await run_until_disconnect(request, work)
+
+@app.post("/chat/{chat_id}/fork")
+async def fork_chat(chat_id: str, at: int = Form(...)):
+    """앞 at개 메시지를 공유하는 분기 생성 (질문 수정: 그 질문 자리에서 분기 후 /chat으로 새 질문 전송)"""
+    async with store_lock_async():
+        refresh_if_stale()
+        if chat_id not in chats or not 0 <= at <= chat_length(chats[chat_id]):
+            return JSONResponse({"error": "분기할 수 없는 위치예요."}, status_code=400)
+        fork_id = f"{int(time.time() * 1000):x}{os.urandom(4).hex()}"
+        open_chat(fork_id, fork_of=(chat_id, at))
+        save_chats()
+    mark_changed(fork_id)
+    count_metric("chat_forks")
+    return JSONResponse({"chat_id": fork_id, **chat_summary(fork_id)})
+
+CHAT_LIST_PAGE = 50    # 채팅 목록 한 페이지 (UI의 CHAT_PAGE와 맞춤)
+CHAT_LIST_MAX = 500
 
 @app.get("/chats")
-async def get_chats():
-    return JSONResponse([
-        {"id": k, "title": v["title"], "created": v["created"], "updated": v.get("updated", v["created"]), "messageCount": len(v["messages"])}
-        for k, v in sorted(chats.items(), key=lambda x: x[1].get("updated", x[1]["created"]), reverse=True)
-    ])
+async def get_chats(offset: int = Query(0, ge=0), limit: int = Query(CHAT_LIST_PAGE, ge=1, le=CHAT_LIST_MAX)):
+    """최근 순 채팅 목록 한 페이지 - 전체 개수는 X-Total-Count 헤더"""
+    ids = reversed(recent_index)
+    page = islice(ids, offset, offset + limit)
+    return JSONResponse([chat_summary(k) for k in page], headers={"X-Total-Count": str(len(recent_index)), "X-Store-Revision": revision_token()})
+
+@app.get("/chats/changes")
+async def get_chat_changes(since: str = "", timeout: float = 25.0):
+    """롱폴링 변경 피드 - since 이후 변경이 없으면 timeout초까지 대기"""
+    deadline = time.monotonic() + min(max(timeout, 0), 60)
+    revision = parse_revision(since)
+    while revision == store_revision and time.monotonic() < deadline:
+        try:
+            await asyncio.wait_for(change_event.wait(), timeout=min(CHANGE_POLL, max(deadline - time.monotonic(), 0)))
+        except asyncio.TimeoutError:
+            refresh_if_stale()
+    return JSONResponse(changes_since(since))
+
+@app.get("/chats/events")
+async def chat_events(request: Request, since: str = ""):
+    """SSE 변경 피드 - 재연결 시 Last-Event-ID부터 이어서 전송"""
+    token = request.headers.get("last-event-id") or since
+    
+    async def stream():
+        nonlocal token
+        last_sent = time.monotonic()
+        while not await request.is_disconnected():
+            refresh_if_stale()
+            revision = parse_revision(token)
+            if revision != store_revision:
+                delta = changes_since(token)
+                token = delta["revision"]
+                last_sent = time.monotonic()
+                yield f"id: {token}\nevent: changes\ndata: {json.dumps(delta, ensure_ascii=False)}\n\n"
+                continue
+            try:
+                await asyncio.wait_for(change_event.wait(), timeout=CHANGE_POLL)
+            except asyncio.TimeoutError:
+                if time.monotonic() - last_sent >= CHANGE_HEARTBEAT:
+                    last_sent = time.monotonic()
+                    yield ": ping\n\n"
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.get("/chat/{chat_id}")
 async def get_chat(chat_id: str):
     if chat_id in chats:
-        return JSONResponse(chats[chat_id])
+        data = chat_to_dict(chats[chat_id])
+        await attach_rendered(data["messages"])
+        return JSONResponse(data)
     return JSONResponse({"messages": [], "title": "새 채팅"})
 
 @app.delete("/chat/{chat_id}")
 async def delete_chat(chat_id: str):
-    if chat_id in chats:
-        del chats[chat_id]
-        save_chats()
+    async with store_lock_async():
+        refresh_if_stale()
+        if chat_id in chats:
+            detach_children(chat_id)
+            track_delete(chat_id)
+            release_docs(chat_id)
+            del chats[chat_id]
+            save_chats()
+            mark_changed(chat_id)
     return JSONResponse({"status": "deleted"})
 
 @app.put("/chat/{chat_id}/title")
 async def update_title(chat_id: str, title: str = Form(...)):
-    if chat_id in chats:
-        chats[chat_id]["title"] = title
-        save_chats()
+    async with store_lock_async():
+        refresh_if_stale()
+        if chat_id in chats:
+            chats[chat_id]["title"] = title
+            save_chats()
+            mark_changed(chat_id)
     return JSONResponse({"status": "updated"})
 
 @app.get("/search")
 async def search_chats(q: str = Query(...)):
     results = []
     for chat_id, chat in chats.items():
-        for i, msg in enumerate(chat["messages"]):
-            if q.lower() in msg.get("display", msg["content"]).lower():
+        base = chat_length(chat) - len(chat["messages"])  # 분기는 자기 메시지만 검색 (부모와 중복 방지)
+        for i, msg in enumerate(chat["messages"], base):
+            display = msg.display
+            if q.lower() in display.lower():
                 results.append({
                     "chatId": chat_id,
                     "chatTitle": chat["title"],
                     "messageIndex": i,
-                    "preview": msg.get("display", msg["content"])[:100],
-                    "role": msg["role"]
+                    "preview": display[:100],
+                    "role": msg.role
                 })
     return JSONResponse(results[:20])
 
+# ============ 일괄 문서 작업 (jobs) ============
+# 여러 문서에 같은 지시를 돌림 - 추출은 병렬, 모델 호출은 JOB_CONCURRENCY + RateGovernor 한도 안에서,
+# 문서 하나 끝날 때마다 data/jobs/{id}.json에 체크포인트 → 재시작하면 남은 문서부터 이어서
+JOBS_DIR = os.path.join(DATA_DIR, "jobs")
+JOB_UPLOADS_DIR = os.path.join(JOBS_DIR, "uploads")                 # 채팅 업로드(data/uploads)와 분리 - 채팅을 지워도 작업 원본은 남음
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", "30"))  # 끝난 작업(결과 + 업로드 원본)을 보관할 기간
+JOB_DIR_ROOT = os.getenv("JOB_DIR_ROOT", "")                        # 서버 폴더 작업을 허용할 최상위 경로 (비우면 폴더 작업 불가)
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "2"))            # 워커당 동시 모델 호출 수 (채팅 몫은 남겨둠)
+JOB_EXTRACT_CONCURRENCY = max(1, min(4, os.cpu_count() or 2))       # 동시 추출 수
+JOB_MAX_DOCS = int(os.getenv("JOB_MAX_DOCS", "200"))
+JOB_DOC_TOKENS = FILE_TOKEN_BUDGET   # 문서 하나에 줄 토큰 예산
+JOB_HEARTBEAT = 10    # 초 - 작업을 맡은 워커가 이 주기로 임대 갱신
+JOB_LEASE = 60        # 초 - 이보다 오래 갱신이 없으면 다른 워커가 이어받음
+JOB_RETRIES = 3       # 한도 초과/서킷 차단으로 실패한 문서를 다시 시도할 횟수
+JOB_CLEANUP_INTERVAL = 3600   # 초
+# 폴더 작업이 모을 확장자 - 추출기가 등록된 것만 (예전 .xls 같은 OLE 형식, pyarrow 없을 때 .parquet는 어차피 거절되므로 빼둠)
+JOB_EXTENSIONS = {ext for ext in ('pdf', 'docx', 'xlsx', 'pptx', 'csv', 'tsv', 'txt', 'md', 'json', 'xml', 'html', 'log', 'ipynb', 'parquet')
+                  if ext in EXTENSION_KINDS}
+if SERVER_PROCESS:
+    os.makedirs(JOB_UPLOADS_DIR, exist_ok=True)
+
+jobs: Dict[str, dict] = {}                  # 이 워커가 맡아서 돌리는 작업
+job_tasks: Dict[str, asyncio.Task] = {}
+job_events: Dict[str, asyncio.Event] = {}   # 문서 하나 끝날 때마다 set → SSE 깨움
+job_model_slots = asyncio.Semaphore(JOB_CONCURRENCY)
+job_extract_slots = asyncio.Semaphore(JOB_EXTRACT_CONCURRENCY)
+
+def job_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def read_job(job_id):
+    """작업 상태 - 내가 돌리는 중이면 메모리, 아니면 파일 (다른 워커가 돌리는 중일 수 있음)"""
+    if job_id in jobs:
+        return jobs[job_id]
+    return read_job_file(job_id)
+
+def read_job_file(job_id):
+    try:
+        with open(job_path(job_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_job(job):
+    job["heartbeat"] = time.time()
+    write_json_atomic(job_path(job["id"]), job)
+
+async def commit_job(job):
+    """잠금 안에서 주인을 확인하고 저장 - 그사이 다른 워커가 이어받았으면 덮어쓰지 않고 내 쪽 작업을 멈춤 (False)"""
+    async with store_lock_async():
+        on_disk = read_job_file(job["id"])
+        if on_disk and on_disk.get("owner") not in (None, WORKER_ID):
+            drop_job(job["id"])
+            return False
+        save_job(job)
+    return True
+
+def drop_job(job_id):
+    """다른 워커에게 넘어간 작업을 이 워커에서 내려놓음"""
+    jobs.pop(job_id, None)
+    task = job_tasks.pop(job_id, None)
+    if task and task is not asyncio.current_task():
+        task.cancel()
+
+def job_summary(job):
+    counts = Counter(d["status"] for d in job["docs"])
+    return {"id": job["id"], "status": job["status"], "prompt": job["prompt"][:100], "model": job["model"],
+            "created": job["created"], "total": len(job["docs"]), "done": counts["done"], "errors": counts["error"],
+            "pending": counts["pending"] + counts["running"]}
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _extract_job_doc(doc):
+    """문서 하나 추출 (워커 스레드) - 업로드는 내용 해시로, 서버 폴더 파일은 경로로 읽음
+    PDF도 그 파일에서 바로 읽음 → 채팅 저장소(data/uploads, data/pdf_pages)에 복사본이 남지 않음"""
+    digest = doc.get("sha256") or _hash_file(doc["path"])
+    with open(doc["path"], 'rb') as f:
+        return extract_cached(f, doc["name"], digest, chars_for_tokens(JOB_DOC_TOKENS), path=doc["path"])
+
+def _store_job_upload(spool, digest, filename):
+    """업로드를 내용 해시 이름으로 보관 (같은 파일을 여러 작업에 올려도 한 번만)"""
+    ext = filename.lower().rsplit('.', 1)[-1] if '.' in filename else 'bin'
+    path = os.path.join(JOB_UPLOADS_DIR, f"{digest}.{ext}")
+    if not os.path.exists(path):
+        spool.seek(0)
+        copy_file_atomic(spool, path)
+    return path
+
+def list_job_directory(directory):
+    """JOB_DIR_ROOT 아래 폴더의 지원 형식 파일 목록 (하위 폴더 포함, 경로 탈출 차단)"""
+    if not JOB_DIR_ROOT:
+        raise ValueError("서버 폴더 작업이 꺼져 있어요 (.env의 JOB_DIR_ROOT 설정 필요).")
+    root = os.path.realpath(JOB_DIR_ROOT)
+    target = os.path.realpath(os.path.join(root, directory))
+    if os.path.commonpath([root, target]) != root or not os.path.isdir(target):
+        raise ValueError(f"폴더를 찾을 수 없어요: {directory}")
+    found = []
+    for dirpath, dirnames, filenames in os.walk(target):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if name.startswith('.') or name.lower().rsplit('.', 1)[-1] not in JOB_EXTENSIONS:
+                continue
+            if os.path.getsize(path) <= MAX_FILE_BYTES:
+                found.append({"name": os.path.relpath(path, target), "path": path})
+    return found
+
+def job_messages(job, name, text):
+    """지시(모든 문서 공통)를 앞에 두고 캐시 지점을 찍어서, 시스템 프롬프트 + 지시 캐시를 배치 전체가 나눠 씀"""
+    return [{"role": "user", "content": [
+        {"type": "text", "text": f"[일괄 검토 지시]\n{job['prompt']}", "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": fit_files_to_budget([(name, text)], JOB_DOC_TOKENS)[0]},
+    ]}]
+
+async def _finish_doc(job, doc, **fields):
+    doc.update(fields, finished=datetime.now().isoformat())
+    job["seq"] += 1
+    doc["seq"] = job["seq"]
+    if await commit_job(job):
+        job_events.setdefault(job["id"], asyncio.Event()).set()
+
+async def run_job_doc(job, doc):
+    try:
+        async with job_extract_slots:
+            text = await asyncio.to_thread(_extract_job_doc, doc)
+    except Exception as e:
+        await _finish_doc(job, doc, status="error", error=f"추출 실패: {e}")
+        return
+    if not text:
+        await _finish_doc(job, doc, status="error", error="텍스트를 추출하지 못했어요.")
+        return
+    messages = job_messages(job, doc["name"], text)
+    estimated = estimate_prompt_tokens(CACHED_SYSTEM, messages)
+    for attempt in range(JOB_RETRIES + 1):
+        try:
+            async with job_model_slots:
+                doc["status"] = "running"
+                started = time.monotonic()
+                response, waited = await governor.call(
+                    estimated, model=job["model"], max_tokens=job["max_tokens"], system=CACHED_SYSTEM,
+                    messages=messages, extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
+                )
+            break
+        except (CircuitOpenError, RateLimitError) as e:
+            doc["status"] = "pending"
+            if attempt == JOB_RETRIES:
+                await _finish_doc(job, doc, status="error", error="API 한도 초과로 중단")
+                return
+            await asyncio.sleep(getattr(e, "retry_in", None) or _retry_after(e, 30.0))
+        except (APIConnectionError, APIStatusError) as e:
+            await _finish_doc(job, doc, status="error", error=f"API 오류: {getattr(e, 'message', e)}")
+            return
+    usage = {
+        "input_tokens": response.usage.input_tokens,
+        "output_tokens": response.usage.output_tokens,
+        "cache_read": getattr(response.usage, 'cache_read_input_tokens', 0) or 0,
+        "cache_create": getattr(response.usage, 'cache_creation_input_tokens', 0) or 0,
+    }
+    async with store_lock_async():
+        note_model_use(job["model"], usage)
+    count_metric("job_docs")
+    count_metric("job_latency_ms", int((time.monotonic() - started - waited) * 1000))
+    for key in ("input_tokens", "output_tokens", "cache_read", "cache_create"):
+        count_metric(key, usage[key])
+    await _finish_doc(job, doc, status="done", result=response.content[0].text, usage=usage)
+
+async def run_job(job_id):
+    job = jobs[job_id]
+    try:
+        job["status"] = "running"
+        if not await commit_job(job):
+            return
+        todo = [doc for doc in job["docs"] if doc["status"] in ("pending", "running")]
+        # 문서 하나의 예상 밖 오류는 그 문서만 실패로 기록 (나머지는 계속)
+        results = await asyncio.gather(*(run_job_doc(job, doc) for doc in todo), return_exceptions=True)
+        if job_id not in jobs:
+            return  # 도중에 다른 워커가 이어받음
+        for doc, result in zip(todo, results):
+            if isinstance(result, Exception) and doc["status"] not in ("done", "error"):
+                print("".join(traceback.format_exception(type(result), result, result.__traceback__)))
+                await _finish_doc(job, doc, status="error", error=f"처리 실패: {result}")
+        job["status"] = "done"
+        job["finished"] = datetime.now().isoformat()
+        if await commit_job(job):
+            print(f"📦 작업 {job_id} 완료 ({len(job['docs'])}개 문서)")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(traceback.format_exc())
+        job["status"] = "failed"
+        job["error"] = str(e)
+        await commit_job(job)
+    finally:
+        if job_id in job_events:
+            job_events.pop(job_id).set()
+        if job["status"] in ("done", "failed"):
+            jobs.pop(job_id, None)
+            job_tasks.pop(job_id, None)
+
+def start_job(job):
+    jobs[job["id"]] = job
+    job_tasks[job["id"]] = asyncio.create_task(run_job(job["id"]))
+
+async def claim_orphan_jobs():
+    """임대가 끊긴(주인이 죽었거나 정상 종료한) 미완료 작업을 이어받음 - 잠금 안에서 주인 확인 후 가져감"""
+    now = time.time()
+    for name in os.listdir(JOBS_DIR):
+        job_id = name[:-5]
+        if not name.endswith(".json") or job_id in jobs:
+            continue
+        async with store_lock_async():
+            job = read_job_file(job_id)
+            if not job or job["status"] not in ("queued", "running"):
+                continue
+            if job.get("owner") and now - job.get("heartbeat", 0) < JOB_LEASE:
+                continue
+            job["owner"] = WORKER_ID
+            save_job(job)
+        print(f"📦 작업 {job_id} 이어서 진행 ({job_summary(job)['pending']}개 남음)")
+        start_job(job)
+
+async def renew_job_leases():
+    """내 작업의 임대 갱신 - 그사이 다른 워커가 가져갔으면 (오래 멈췄던 경우) 내 쪽을 멈춤"""
+    for job_id in list(jobs):
+        if job_id in jobs:
+            await commit_job(jobs[job_id])
+
+def cleanup_jobs():
+    """보관 기간이 지난 끝난 작업 파일과, 남은 작업 어디에서도 쓰지 않는 작업 업로드 원본을 지움 (잠금 안에서)"""
+    cutoff = time.time() - JOB_RETENTION_DAYS * 86400
+    in_use = set()
+    removed = 0
+    with store_lock():
+        for name in os.listdir(JOBS_DIR):
+            if not name.endswith(".json"):
+                continue
+            job = read_job_file(name[:-5])
+            if not job:
+                continue
+            if job["status"] in ("done", "failed") and job.get("heartbeat", 0) < cutoff:
+                try:
+                    os.remove(job_path(job["id"]))
+                    removed += 1
+                    continue
+                except OSError:
+                    pass
+            in_use.update(doc.get("path") for doc in job["docs"])
+        for name in os.listdir(JOB_UPLOADS_DIR):
+            path = os.path.join(JOB_UPLOADS_DIR, name)
+            # 막 올라와서 아직 작업 파일에 안 적힌 업로드는 건드리지 않음
+            if path not in in_use and os.path.getmtime(path) < time.time() - JOB_CLEANUP_INTERVAL:
+                try: os.remove(path)
+                except OSError: pass
+    if removed:
+        print(f"🧹 오래된 작업 {removed}개 정리")
+
+async def _job_supervisor():
+    last_cleanup = 0.0
+    while True:
+        try:
+            await claim_orphan_jobs()
+        except Exception as e:
+            print(f"작업 재개 확인 실패: {e}")
+        if JOB_RETENTION_DAYS > 0 and time.monotonic() - last_cleanup >= JOB_CLEANUP_INTERVAL:
+            last_cleanup = time.monotonic()
+            try:
+                await asyncio.to_thread(cleanup_jobs)
+            except OSError as e:
+                print(f"작업 정리 실패: {e}")
+        await asyncio.sleep(JOB_HEARTBEAT)
+        try:
+            await renew_job_leases()
+        except OSError as e:
+            print(f"작업 임대 갱신 실패: {e}")
+
+async def _start_jobs():
+    _background_tasks.append(asyncio.create_task(_job_supervisor()))
+
+async def _stop_jobs():
+    """정상 종료면 임대를 풀어서 재시작 직후 바로 이어받게 함"""
+    for job_id, task in list(job_tasks.items()):
+        task.cancel()
+        job = jobs.get(job_id)
+        if job:
+            for doc in job["docs"]:
+                if doc["status"] == "running":
+                    doc["status"] = "pending"
+            job["owner"] = None
+            await commit_job(job)
+
+startup_hooks.append(_start_jobs)
+shutdown_hooks.append(_stop_jobs)
+
+@app.post("/jobs")
+async def create_job(prompt: str = Form(...), files: List[UploadFile] = File(default=[]), directory: str = Form(default=""), tier: str = Form(default="heavy")):
+    """일괄 작업 생성 - 파일 업로드 또는 JOB_DIR_ROOT 아래 폴더 + 공통 지시"""
+    prompt = prompt.strip()
+    if not prompt:
+        return JSONResponse({"error": "지시(prompt)를 입력해주세요."}, status_code=400)
+    docs = []
+    remaining = MAX_REQUEST_BYTES
+    for file in files:
+        if not file.filename:
+            continue
+        try:
+            spool, digest, size = await hash_upload(file, remaining)
+        except UploadTooLarge as e:
+            return JSONResponse({"error": str(e)}, status_code=413)
+        remaining -= size
+        with spool:
+            path = await asyncio.to_thread(_store_job_upload, spool, digest, file.filename)
+        docs.append({"name": file.filename, "path": path, "sha256": digest})
+    if directory:
+        try:
+            docs += await asyncio.to_thread(list_job_directory, directory)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+    if not docs:
+        return JSONResponse({"error": "처리할 문서가 없어요."}, status_code=400)
+    if len(docs) > JOB_MAX_DOCS:
+        return JSONResponse({"error": f"작업 하나에 최대 {JOB_MAX_DOCS}개 문서까지예요 ({len(docs)}개)."}, status_code=400)
+    route = tier if tier in MODEL_TIERS else "heavy"
+    job = {
+        "id": f"job_{int(time.time() * 1000)}_{os.urandom(3).hex()}",
+        "prompt": prompt, "model": MODEL_TIERS[route]["model"], "max_tokens": MODEL_TIERS[route]["max_tokens"],
+        "status": "queued", "created": datetime.now().isoformat(), "owner": WORKER_ID, "seq": 0,
+        "docs": [{"index": i, "status": "pending", **doc} for i, doc in enumerate(docs)],
+    }
+    save_job(job)
+    start_job(job)
+    count_metric("jobs_created")
+    return JSONResponse(job_summary(job), status_code=202)
+
+@app.get("/jobs")
+async def list_jobs():
+    found = [read_job(name[:-5]) for name in os.listdir(JOBS_DIR) if name.endswith(".json")]
+    return JSONResponse(sorted((job_summary(j) for j in found if j), key=lambda j: j["created"], reverse=True))
+
+def _public_doc(doc):
+    return {k: v for k, v in doc.items() if k not in ("path", "sha256")}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = read_job(job_id)
+    if not job:
+        return JSONResponse({"error": "작업을 찾을 수 없어요."}, status_code=404)
+    return JSONResponse({**job_summary(job), "prompt": job["prompt"], "docs": [_public_doc(d) for d in job["docs"]]})
+
+@app.get("/jobs/{job_id}/events")
+async def job_events_stream(request: Request, job_id: str, since: int = 0):
+    """SSE - 문서 결과가 나오는 대로 전송 (이벤트 id = 완료 순번, 재연결 시 Last-Event-ID 이후부터)"""
+    if not read_job(job_id):
+        return JSONResponse({"error": "작업을 찾을 수 없어요."}, status_code=404)
+    try:
+        last = int(request.headers.get("last-event-id") or since or 0)
+    except ValueError:
+        last = since
+    
+    async def stream():
+        nonlocal last
+        last_sent = time.monotonic()
+        event = job_events.setdefault(job_id, asyncio.Event())
+        while not await request.is_disconnected():
+            event.clear()
+            job = read_job(job_id)
+            fresh = sorted((d for d in job["docs"] if d.get("seq", 0) > last), key=lambda d: d["seq"])
+            for doc in fresh:
+                last = doc["seq"]
+                last_sent = time.monotonic()
+                yield f"id: {last}\nevent: doc\ndata: {json.dumps(_public_doc(doc), ensure_ascii=False)}\n\n"
+            if job["status"] in ("done", "failed"):
+                yield f"event: status\ndata: {json.dumps(job_summary(job), ensure_ascii=False)}\n\n"
+                return
+            try:
+                # 다른 워커가 돌리는 작업은 파일을 주기적으로 다시 읽음
+                await asyncio.wait_for(event.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                if time.monotonic() - last_sent >= CHANGE_HEARTBEAT:
+                    last_sent = time.monotonic()
+                    yield ": ping\n\n"
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ============ 내보내기 (스트리밍) ============
+EXPORT_FORMATS = {
+    "md": ("text/markdown; charset=utf-8", "md"),
+    "jsonl": ("application/x-ndjson; charset=utf-8", "jsonl"),
+    "html": ("text/html; charset=utf-8", "html"),
+}
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+EXPORT_HTML_HEAD = """<!DOCTYPE html>
+<html lang="ko"><head><meta charset="UTF-8"><title>{title}</title>
+<style>
+body{{font-family:-apple-system,'Pretendard',sans-serif;max-width:860px;margin:2rem auto;padding:0 1rem;line-height:1.6;color:#222}}
+.meta{{color:#888;font-size:.9rem}}
+.msg{{border-top:1px solid #ddd;padding:1rem 0}}
+.role{{font-weight:bold;margin-bottom:.5rem}}
+.body{{white-space:pre-wrap;word-break:break-word}}
+</style></head><body>
+<h1>{title}</h1>
+<div class="meta">생성: {created}</div>
+"""
+
+def iter_export_md(chat_id, chat):
+    """채팅을 마크다운 조각 단위로 생성"""
+    yield f"# {chat['title']}\n\n생성: {chat['created']}\n\n---\n\n"
+    for msg in chat_history(chat):
+        role = "👤 나" if msg.role == "user" else "🤖 AI"
+        yield f"## {role}\n\n{msg.display}\n\n---\n\n"
+
+def iter_export_jsonl(chat_id, chat):
+    """채팅을 JSONL 조각 단위로 생성 (첫 줄은 채팅 메타데이터)"""
+    meta = {"type": "chat", "id": chat_id, "title": chat["title"], "created": chat["created"], "updated": chat.get("updated", chat["created"])}
+    yield json.dumps(meta, ensure_ascii=False) + "\n"
+    for msg in chat_history(chat):
+        yield json.dumps({"type": "message", **msg.to_dict()}, ensure_ascii=False) + "\n"
+
+def iter_export_html(chat_id, chat):
+    """채팅을 독립 실행 HTML 조각 단위로 생성"""
+    yield EXPORT_HTML_HEAD.format(title=html_escape(chat["title"]), created=html_escape(chat["created"]))
+    for msg in chat_history(chat):
+        role = "👤 나" if msg.role == "user" else "🤖 AI"
+        body = html_escape(msg.display)
+        yield f'<div class="msg {msg.role}"><div class="role">{role}</div><div class="body">{body}</div></div>\n'
+    yield "</body></html>\n"
+
+EXPORTERS = {"md": iter_export_md, "jsonl": iter_export_jsonl, "html": iter_export_html}
+
+def iter_export_bytes(chat_id, chat, fmt):
+    """내보내기 조각을 UTF-8로 인코딩하고 작은 조각은 묶어서 내보냄"""
+    buf = []
+    size = 0
+    for piece in EXPORTERS[fmt](chat_id, chat):
+        data = piece.encode('utf-8')
+        buf.append(data)
+        size += len(data)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield b"".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b"".join(buf)
+
+class _ZipSink:
+    """zipfile이 쓴 바이트를 모아 두었다가 조금씩 흘려보내는 출력 버퍼 (seek 불가)"""
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
+
+def export_filename(chat_id, chat, ext):
+    """zip 안에 들어갈 파일 이름 (제목 + ID)"""
+    title = re.sub(r'[\\/:*?"<>|\s]+', '_', chat.get("title", "")).strip('_')[:40]
+    return f"{title}_{chat_id}.{ext}" if title else f"{chat_id}.{ext}"
+
+def iter_export_zip(chat_ids, fmt):
+    """여러 채팅을 zip으로 스트리밍 - 메모리는 채팅 하나의 조각 크기만큼만 사용"""
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for chat_id in chat_ids:
+            chat = chats.get(chat_id)
+            if chat is None:  # 내보내는 도중 삭제된 채팅
+                continue
+            with zf.open(export_filename(chat_id, chat, EXPORT_FORMATS[fmt][1]), 'w') as entry:
+                for data in iter_export_bytes(chat_id, chat, fmt):
+                    entry.write(data)
+                    if len(sink.buf) >= EXPORT_CHUNK_SIZE:
+                        yield sink.drain()
+            if sink.buf:
+                yield sink.drain()
+    yield sink.drain()
+
 @app.get("/export/{chat_id}")
 async def export_chat(chat_id: str, format: str = "md"):
     if chat_id not in chats:
         return JSONResponse({"error": "채팅을 찾을 수 없습니다"}, status_code=404)
     
     chat = chats[chat_id]
-    if format == "md":
-        content = f"# {chat['title']}\n\n생성: {chat['created']}\n\n---\n\n"
-        for msg in chat["messages"]:
-            role = "👤 나" if msg["role"] == "user" else "🤖 AI"
-            content += f"## {role}\n\n{msg.get('display', msg['content'])}\n\n---\n\n"
+    if format in EXPORT_FORMATS:
+        media_type, ext = EXPORT_FORMATS[format]
         return StreamingResponse(
-            iter([content.encode('utf-8')]),
-            media_type="text/markdown",
-            headers={"Content-Disposition": f"attachment; filename={chat_id}.md"}
+            iter_export_bytes(chat_id, chat, format),
+            media_type=media_type,
+            headers={"Content-Disposition": f"attachment; filename={chat_id}.{ext}"}
         )
     else:
-        return JSONResponse(chat)
+        return JSONResponse(chat_to_dict(chat))  # 메시지는 Message 객체라 dict로 펼쳐서
+
+@app.get("/export")
+async def export_all(format: str = "md", ids: str = "", q: str = "", since: str = "", until: str = ""):
+    """전체 또는 조건에 맞는 채팅을 zip으로 내보내기"""
+    if format not in EXPORT_FORMATS:
+        return JSONResponse({"error": f"지원하지 않는 형식: {format}"}, status_code=400)
+    
+    wanted = set(i for i in ids.split(",") if i) if ids else None
+    selected = []
+    for chat_id, chat in list(chats.items()):
+        updated = chat.get("updated", chat["created"])
+        if wanted is not None and chat_id not in wanted: continue
+        if q and q.lower() not in chat["title"].lower(): continue
+        if since and updated < since: continue
+        if until and updated > until: continue
+        selected.append(chat_id)
+    
+    filename = f"harimcraft_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return StreamingResponse(
+        iter_export_zip(selected, format),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
 
 @app.get("/settings")
 async def get_settings():
     return JSONResponse(settings)
 
 @app.post("/settings")
-async def update_settings(theme: str = Form(None), fontSize: str = Form(None)):
-    if theme: settings["theme"] = theme
-    if fontSize: settings["fontSize"] = fontSize
-    save_settings()
+async def update_settings(theme: str = Form(None), fontSize: str = Form(None), tier: str = Form(None)):
+    async with store_lock_async():
+        refresh_if_stale()
+        if theme: settings["theme"] = theme
+        if fontSize: settings["fontSize"] = fontSize
+        if tier in ("auto", *MODEL_TIERS): settings["tier"] = tier
+        save_settings()
     return JSONResponse(settings)
 
 @app.get("/stats")
-async def get_stats():
-    total_messages = sum(len(c["messages"]) for c in chats.values())
+async def get_stats(days: int = 30):
+    oldest = next(iter(chats), None)
+    newest = next(reversed(recent_index), None)
+    daily = [{"date": d, **daily_stats[d]} for d in sorted(daily_stats)[-days:]] if days > 0 else []
     return JSONResponse({
         "totalChats": len(chats),
-        "totalMessages": total_messages,
-        "oldestChat": min((c["created"] for c in chats.values()), default=None),
-        "newestChat": max((c.get("updated", c["created"]) for c in chats.values()), default=None)
+        "totalMessages": stats_totals["messages"],
+        "oldestChat": chats[oldest]["created"] if oldest else None,
+        "newestChat": chats[newest].get("updated", chats[newest]["created"]) if newest else None,
+        "inputTokens": stats_totals["input_tokens"],
+        "outputTokens": stats_totals["output_tokens"],
+        "totalTokens": stats_totals["input_tokens"] + stats_totals["output_tokens"],
+        "daily": daily
     })
 
+@app.get("/metrics")
+async def get_metrics():
+    """워커별 + 합산 런타임 메트릭"""
+    collected = collect_metrics()
+    return JSONResponse({"workerCount": WORKERS, "governor": governor.snapshot(), "cacheWarmer": cache_warmer_report(collected["total"]), **collected})
+
 @app.get("/web-search")
-async def web_search_endpoint(q: str = Query(...)):
-    """수동 웹 검색 엔드포인트"""
-    results = await web_search(q, num_results=8)
+async def web_search_endpoint(q: str = Query(...), deep: str = ""):
+    """수동 웹 검색 엔드포인트 (deep=1이면 상위 결과 본문 포함)"""
+    results = await web_search(q, num_results=8, deep=wants_deep_search(q, deep))
     return JSONResponse({"query": q, "results": results})
 
 @app.get("/", response_class=HTMLResponse)
@@ -557,6 +3251,8 @@ body.font-large{font-size:22px}
 .chat-item-btn{padding:.375rem;border:0;background:0;color:var(--text3);cursor:pointer;font-size:1rem}
 .chat-item-btn:hover{color:var(--text)}
 .chat-item-btn.delete:hover{color:var(--error)}
+.chat-list-more{width:100%;padding:.625rem;margin-top:.25rem;border:2px dashed var(--border);background:0;color:var(--text3);cursor:pointer;font-family:inherit;font-size:.9rem}
+.chat-list-more:hover{color:var(--text);background:var(--bg3)}
 
 /* 메인 영역 */
 .main{flex:1;display:flex;flex-direction:column;min-width:0;background:var(--bg)}
@@ -573,6 +3269,8 @@ body.font-large{font-size:22px}
 .message{display:flex;gap:1rem;animation:fadeIn .3s;max-width:850px;width:100%;margin:0 auto}
 @keyframes fadeIn{from{opacity:0;transform:translateY(10px)}to{opacity:1}}
 .message.user{flex-direction:row-reverse}
+.msg-actions{display:flex;flex-direction:column;justify-content:flex-end;opacity:0;transition:opacity .2s}
+.message:hover .msg-actions{opacity:1}
 .avatar{width:40px;height:40px;border:3px solid;display:flex;align-items:center;justify-content:center;font-size:1rem;flex-shrink:0}
 .message.assistant .avatar{background:var(--grass);border-color:#7cb342 #3d5c1f #3d5c1f #7cb342}
 .message.user .avatar{background:var(--diamond);border-color:#7fffff #2a9d9d #2a9d9d #7fffff}
@@ -595,6 +3293,7 @@ body.font-large{font-size:22px}
 .copy-btn.copied{background:var(--grass);color:#fff}
 .code-block pre{margin:0;padding:1rem;overflow-x:auto}
 .code-block code{font-family:'VT323',monospace;font-size:1.1rem;line-height:1.5}
+.bubble math[display=block]{margin:.75rem 0;overflow-x:auto;overflow-y:hidden}
 .bubble code:not(.hljs){background:#1a1a1a;padding:.2rem .5rem;font-size:1rem;color:var(--gold);font-family:'VT323',monospace;border:2px solid #333}
 
 /* 입력 영역 */
@@ -755,6 +3454,22 @@ body.font-large{font-size:22px}
 <button class="setting-btn" data-font="large" onclick="setFontSize('large')">크게</button>
 </div>
 </div>
+<div class="setting-item">
+<div class="setting-label">모델</div>
+<div class="setting-options">
+<button class="setting-btn" data-tier="auto" onclick="setTier('auto')">자동</button>
+<button class="setting-btn" data-tier="fast" onclick="setTier('fast')">빠름</button>
+<button class="setting-btn" data-tier="standard" onclick="setTier('standard')">표준</button>
+<button class="setting-btn" data-tier="heavy" onclick="setTier('heavy')">최고</button>
+</div>
+</div>
+<div class="setting-item">
+<div class="setting-label">내보내기</div>
+<div class="setting-options">
+<button class="setting-btn" onclick="exportChat('html')"><i class="fas fa-file-code"></i> 현재 채팅 HTML</button>
+<button class="setting-btn" onclick="exportAll()"><i class="fas fa-file-zipper"></i> 전체 ZIP</button>
+</div>
+</div>
 </div>
 </div>
 
@@ -770,8 +3485,9 @@ body.font-large{font-size:22px}
 HTML += '''
 <script>
 let currentChatId = null;
+let msgCount = 0;  // 서버에 저장된 메시지 수 (수정/다시 생성 버튼의 위치)
 let selectedFiles = [];
-let settings = {theme: 'dark', fontSize: 'medium'};
+let settings = {theme: 'dark', fontSize: 'medium', tier: 'auto'};
 
 const chat = document.getElementById('chat');
 const msgInput = document.getElementById('msgInput');
@@ -795,16 +3511,22 @@ renderer.code = function(code, lang) {
     } catch(e) {
         highlighted = code;
     }
-    const id = 'code-' + Math.random().toString(36).substr(2,9);
     const langIcon = {'python':'fab fa-python','javascript':'fab fa-js','sql':'fas fa-database','bash':'fas fa-terminal'}[language] || 'fas fa-code';
-    return `<div class="code-block"><div class="code-header"><span class="code-lang"><i class="${langIcon}"></i> ${language}</span><button class="copy-btn" onclick="copyCode('${id}')"><i class="fas fa-copy"></i> 복사</button></div><pre><code id="${id}" class="hljs">${highlighted}</code></pre></div>`;
+    return `<div class="code-block"><div class="code-header"><span class="code-lang"><i class="${langIcon}"></i> ${language}</span><button class="copy-btn" onclick="copyCode(this)"><i class="fas fa-copy"></i> 복사</button></div><pre><code class="hljs">${highlighted}</code></pre></div>`;
 };
 marked.use({renderer, breaks: true});
 
-function copyCode(id) {
-    const code = document.getElementById(id);
+function renderMath(el) {
+    renderMathInElement(el, {
+        delimiters: [{left:'$$',right:'$$',display:true},{left:'$',right:'$',display:false},{left:'\\\\[',right:'\\\\]',display:true},{left:'\\\\(',right:'\\\\)',display:false}],
+        throwOnError: false
+    });
+}
+
+// 코드 블록은 서버 렌더링과 marked 양쪽에서 오므로 id 대신 버튼 위치로 찾음
+function copyCode(btn) {
+    const code = btn.closest('.code-block').querySelector('code');
     navigator.clipboard.writeText(code.textContent).then(() => {
-        const btn = code.closest('.code-block').querySelector('.copy-btn');
         btn.innerHTML = '<i class="fas fa-check"></i> 복사됨';
         btn.classList.add('copied');
         setTimeout(() => { btn.innerHTML = '<i class="fas fa-copy"></i> 복사'; btn.classList.remove('copied'); }, 2000);
@@ -839,6 +3561,7 @@ function applySettings() {
     if (settings.fontSize !== 'medium') document.body.classList.add('font-' + settings.fontSize);
     document.querySelectorAll('[data-theme]').forEach(b => b.classList.toggle('active', b.dataset.theme === settings.theme));
     document.querySelectorAll('[data-font]').forEach(b => b.classList.toggle('active', b.dataset.font === settings.fontSize));
+    document.querySelectorAll('[data-tier]').forEach(b => b.classList.toggle('active', b.dataset.tier === (settings.tier || 'auto')));
 }
 
 async function setTheme(theme) {
@@ -853,31 +3576,160 @@ async function setFontSize(size) {
     await fetch('/settings', {method:'POST', body: new URLSearchParams({fontSize: size})});
 }
 
+async function setTier(tier) {
+    settings.tier = tier;
+    applySettings();
+    await fetch('/settings', {method:'POST', body: new URLSearchParams({tier})});
+}
+
 function openSettings() { document.getElementById('settingsModal').classList.add('active'); }
 function closeSettings() { document.getElementById('settingsModal').classList.remove('active'); }
 function toggleSidebar() { sidebar.classList.toggle('open'); }
 
-// 채팅 목록
+// 채팅 목록 (로컬 캐시 + 서버 변경 피드로 부분 갱신)
+let chatCache = new Map();
+let storeRevision = '';
+let chatEvents = null;
+let chatPolling = false;
+let chatEventsFailed = false;  // SSE가 한 번 끊기면 (프록시 등) 이후로는 롱폴링
+const CHAT_PAGE = 50;
+const EMPTY_CHAT_LIST = '<div class="chat-list-empty" style="padding:1rem;text-align:center;color:var(--text3)">채팅이 없습니다</div>';
+
+function chatItemHtml(c) {
+    return `
+        <div class="chat-item-icon"><i class="fas fa-message"></i></div>
+        <div class="chat-item-content">
+            <div class="chat-item-title">${escapeHtml(c.title)}</div>
+            <div class="chat-item-meta">${formatDate(c.updated)} · ${c.messageCount}개 메시지</div>
+        </div>
+        <div class="chat-item-actions">
+            <button class="chat-item-btn" onclick="event.stopPropagation();renameChat('${c.id}','${escapeHtml(c.title)}')" title="이름 변경"><i class="fas fa-pen"></i></button>
+            <button class="chat-item-btn delete" onclick="event.stopPropagation();deleteChat('${c.id}')" title="삭제"><i class="fas fa-trash"></i></button>
+        </div>`;
+}
+
+function createChatItem(c) {
+    const div = document.createElement('div');
+    div.className = 'chat-item' + (c.id === currentChatId ? ' active' : '');
+    div.dataset.id = c.id;
+    div.onclick = () => loadChat(c.id);
+    div.innerHTML = chatItemHtml(c);
+    return div;
+}
+
 async function loadChatList() {
     try {
-        const res = await fetch('/chats');
+        const res = await fetch('/chats?limit=' + CHAT_PAGE);
         const chats = await res.json();
-        chatList.innerHTML = chats.map(c => `
-            <div class="chat-item ${c.id === currentChatId ? 'active' : ''}" onclick="loadChat('${c.id}')">
-                <div class="chat-item-icon"><i class="fas fa-message"></i></div>
-                <div class="chat-item-content">
-                    <div class="chat-item-title">${escapeHtml(c.title)}</div>
-                    <div class="chat-item-meta">${formatDate(c.updated)} · ${c.messageCount}개 메시지</div>
-                </div>
-                <div class="chat-item-actions">
-                    <button class="chat-item-btn" onclick="event.stopPropagation();renameChat('${c.id}','${escapeHtml(c.title)}')" title="이름 변경"><i class="fas fa-pen"></i></button>
-                    <button class="chat-item-btn delete" onclick="event.stopPropagation();deleteChat('${c.id}')" title="삭제"><i class="fas fa-trash"></i></button>
-                </div>
-            </div>
-        `).join('') || '<div style="padding:1rem;text-align:center;color:var(--text3)">채팅이 없습니다</div>';
+        storeRevision = res.headers.get('X-Store-Revision') || '';
+        chatCache = new Map(chats.map(c => [c.id, c]));
+        chatList.innerHTML = '';
+        chats.forEach(c => chatList.appendChild(createChatItem(c)));
+        if (!chats.length) chatList.innerHTML = EMPTY_CHAT_LIST;
+        setMoreButton(chats.length, res);
+        startChatEvents();
     } catch(e) {}
 }
 
+function setMoreButton(received, res) {
+    // 받은 개수가 페이지보다 적거나 전체를 다 받았으면 "더 보기" 숨김
+    const old = chatList.querySelector('.chat-list-more');
+    if (old) old.remove();
+    const total = parseInt(res.headers.get('X-Total-Count') || '0', 10);
+    if (received < CHAT_PAGE || chatCache.size >= total) return;
+    const btn = document.createElement('button');
+    btn.className = 'chat-list-more';
+    btn.textContent = `더 보기 (${chatCache.size}/${total})`;
+    btn.onclick = loadMoreChats;
+    chatList.appendChild(btn);
+}
+
+async function loadMoreChats() {
+    // 그동안 위에 새로 생긴 채팅도 chatCache에 들어 있으므로 chatCache 크기를 오프셋으로 씀 (겹치는 항목은 건너뜀)
+    const btn = chatList.querySelector('.chat-list-more');
+    if (btn) btn.disabled = true;
+    try {
+        const res = await fetch(`/chats?offset=${chatCache.size}&limit=${CHAT_PAGE}`);
+        const chats = await res.json();
+        const more = chatList.querySelector('.chat-list-more');
+        chats.filter(c => !chatCache.has(c.id)).forEach(c => {
+            chatCache.set(c.id, c);
+            chatList.insertBefore(createChatItem(c), more);
+        });
+        setMoreButton(chats.length, res);
+    } catch(e) {
+        if (btn) btn.disabled = false;
+    }
+}
+
+function patchChatList(changes) {
+    const empty = chatList.querySelector('.chat-list-empty');
+    if (empty) empty.remove();
+    changes.forEach(c => {
+        const node = chatList.querySelector(`.chat-item[data-id="${c.id}"]`);
+        if (c.deleted) {
+            chatCache.delete(c.id);
+            if (node) node.remove();
+            return;
+        }
+        const prev = chatCache.get(c.id);
+        chatCache.set(c.id, c);
+        const item = node || createChatItem(c);
+        if (node) item.innerHTML = chatItemHtml(c);
+        // updated가 바뀐 항목만 정렬 위치로 이동
+        if (!node || !prev || prev.updated !== c.updated) {
+            const next = Array.from(chatList.children).find(el => el !== item && (chatCache.get(el.dataset.id) || {}).updated < c.updated);
+            chatList.insertBefore(item, next || chatList.querySelector('.chat-list-more'));
+        }
+    });
+    if (!chatCache.size) chatList.innerHTML = EMPTY_CHAT_LIST;
+}
+
+function applyChatDelta(delta) {
+    storeRevision = delta.revision;
+    if (delta.reset) { stopChatEvents(); loadChatList(); return false; }
+    patchChatList(delta.changes);
+    return true;
+}
+
+function stopChatEvents() {
+    if (chatEvents) { chatEvents.close(); chatEvents = null; }
+    chatPolling = false;
+}
+
+function startChatEvents() {
+    if (chatEvents || chatPolling) return;
+    if (!window.EventSource || chatEventsFailed) { pollChatChanges(); return; }
+    chatEvents = new EventSource('/chats/events?since=' + encodeURIComponent(storeRevision));
+    chatEvents.addEventListener('changes', e => applyChatDelta(JSON.parse(e.data)));
+    chatEvents.onerror = () => {
+        chatEventsFailed = true;
+        stopChatEvents();
+        pollChatChanges();
+    };
+}
+
+async function pollChatChanges() {
+    // /chats/changes 롱폴링 - 변경이 없으면 서버가 최대 25초 잡고 있다가 빈 응답
+    if (chatPolling) return;
+    chatPolling = true;
+    while (chatPolling) {
+        try {
+            const res = await fetch('/chats/changes?timeout=25&since=' + encodeURIComponent(storeRevision));
+            if (!res.ok) throw new Error(res.status);
+            const delta = await res.json();
+            if (!chatPolling) return;
+            if (!applyChatDelta(delta)) return;
+        } catch(e) {
+            await new Promise(r => setTimeout(r, 5000));
+        }
+    }
+}
+
+function setActiveChat(chatId) {
+    chatList.querySelectorAll('.chat-item').forEach(el => el.classList.toggle('active', el.dataset.id === chatId));
+}
+
 function escapeHtml(str) {
     return str.replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;');
 }
@@ -889,9 +3741,10 @@ async function loadChat(chatId) {
         const data = await res.json();
         headerTitle.textContent = data.title || '새 채팅';
         chat.innerHTML = '';
-        data.messages.forEach(m => addMsg(m.display || m.content, m.role === 'user', false));
+        data.messages.forEach((m, i) => addMsg(m.display || m.content, m.role === 'user', false, i, m));
+        msgCount = data.messages.length;
         if (!data.messages.length) showEmptyState();
-        loadChatList();
+        setActiveChat(chatId);
         chat.scrollTop = chat.scrollHeight;
         sidebar.classList.remove('open');
     } catch(e) {}
@@ -899,10 +3752,11 @@ async function loadChat(chatId) {
 
 function newChat() {
     currentChatId = generateId();
+    msgCount = 0;
     headerTitle.textContent = '새 채팅';
     showEmptyState();
     tokenInfo.innerHTML = '';
-    loadChatList();
+    setActiveChat(currentChatId);
     sidebar.classList.remove('open');
 }
 
@@ -918,7 +3772,6 @@ async function deleteChat(chatId) {
     if (!confirm('이 채팅을 삭제할까요?')) return;
     await fetch('/chat/' + chatId, {method: 'DELETE'});
     if (chatId === currentChatId) newChat();
-    else loadChatList();
 }
 
 async function renameChat(chatId, currentTitle) {
@@ -926,13 +3779,16 @@ async function renameChat(chatId, currentTitle) {
     if (newTitle && newTitle !== currentTitle) {
         await fetch('/chat/' + chatId + '/title', {method:'PUT', body: new URLSearchParams({title: newTitle})});
         if (chatId === currentChatId) headerTitle.textContent = newTitle;
-        loadChatList();
     }
 }
 
-async function exportChat() {
+async function exportChat(format='md') {
     if (!currentChatId) return;
-    window.open('/export/' + currentChatId + '?format=md', '_blank');
+    window.open('/export/' + currentChatId + '?format=' + format, '_blank');
+}
+
+function exportAll(format='md') {
+    window.open('/export?format=' + format, '_blank');
 }
 
 // 검색
@@ -998,7 +3854,8 @@ function removeFile(i) { selectedFiles.splice(i, 1); updateFiles(); }
 function clearFiles() { selectedFiles = []; fileInput.value = ''; updateFiles(); }
 
 // 메시지
-function addMsg(content, isUser, scroll=true) {
+// rendered: 서버가 미리 렌더링한 {html, math} - 있으면 marked/KaTeX를 건너뜀
+function addMsg(content, isUser, scroll=true, index=null, rendered=null) {
     const empty = chat.querySelector('.empty-state');
     if (empty) empty.remove();
     
@@ -1009,17 +3866,79 @@ function addMsg(content, isUser, scroll=true) {
     
     if (isUser) {
         bubble.textContent = content;
+    } else if (rendered && rendered.html) {
+        bubble.innerHTML = rendered.html;
+        if (rendered.math) { try { renderMath(bubble); } catch(e) {} }
     } else {
         try {
             bubble.innerHTML = marked.parse(content || '');
-            renderMathInElement(bubble, {
-                delimiters: [{left:'$$',right:'$$',display:true},{left:'$',right:'$',display:false},{left:'\\\\[',right:'\\\\]',display:true},{left:'\\\\(',right:'\\\\)',display:false}],
-                throwOnError: false
-            });
+            renderMath(bubble);
         } catch(e) { bubble.textContent = content || ''; }
     }
+    if (index !== null) addMsgActions(div, index, isUser, content);
     chat.appendChild(div);
     if (scroll) chat.scrollTop = chat.scrollHeight;
+    return div;
+}
+
+function addMsgActions(div, index, isUser, content) {
+    const actions = document.createElement('div');
+    actions.className = 'msg-actions';
+    const btn = document.createElement('button');
+    btn.className = 'chat-item-btn';
+    if (isUser) {
+        btn.title = '질문 수정 (분기)';
+        btn.innerHTML = '<i class="fas fa-pen"></i>';
+        btn.onclick = () => editMessage(index, content);
+    } else {
+        btn.title = '다시 생성 (분기)';
+        btn.innerHTML = '<i class="fas fa-rotate-right"></i>';
+        btn.onclick = () => regenerateAt(index);
+    }
+    actions.appendChild(btn);
+    div.appendChild(actions);
+}
+
+// 분기 - 원래 채팅은 그대로 두고 앞부분을 공유하는 새 채팅에서 이어감
+async function editMessage(index, text) {
+    const edited = prompt('질문 수정:', text.replace(/^🔍 /, ''));
+    if (!edited || !edited.trim()) return;
+    const res = await fetch('/chat/' + currentChatId + '/fork', {method:'POST', body: new URLSearchParams({at: index})});
+    if (!res.ok) return;
+    const data = await res.json();
+    await loadChat(data.chat_id);
+    msgInput.value = edited.trim();
+    sendMessage();
+}
+
+async function regenerateAt(index) {
+    const sourceId = currentChatId;
+    sendBtn.disabled = true;
+    showTyping();
+    try {
+        const res = await fetch('/chat/' + sourceId + '/regenerate', {method:'POST', body: new URLSearchParams({at: index, tier: settings.tier || 'auto'})});
+        const data = await res.json();
+        hideTyping();
+        if (data.chat_id) {
+            await loadChat(data.chat_id);
+            showTokenInfo(data);
+        } else {
+            addMsg(data.response || '응답을 받지 못했습니다.', false);
+        }
+    } catch(e) {
+        hideTyping();
+        addMsg('⚠️ ' + e.message, false);
+    }
+    sendBtn.disabled = false;
+}
+
+function showTokenInfo(data) {
+    if (!(data.tokens_used > 0)) return;
+    let info = `<span><i class="fas fa-coins"></i> ${data.tokens_used.toLocaleString()} 토큰</span>`;
+    if (data.cache_read > 0) info += `<span><i class="fas fa-bolt"></i> 캐시 ${data.cache_read.toLocaleString()}</span>`;
+    if (data.model) info += `<span><i class="fas fa-microchip"></i> ${escapeHtml(data.model.replace(/^claude-/, '').replace(/-\\d{8}$/, ''))} · ${(data.latency_ms/1000).toFixed(1)}초</span>`;
+    if (data.queue_wait_ms >= 1000) info += `<span><i class="fas fa-hourglass-half"></i> 대기 ${(data.queue_wait_ms/1000).toFixed(1)}초</span>`;
+    tokenInfo.innerHTML = info;
 }
 
 function showTyping() {
@@ -1038,7 +3957,7 @@ async function sendMessage() {
     if (!currentChatId) currentChatId = generateId();
     
     const displayMsg = msg + (selectedFiles.length ? ' 📎 ' + selectedFiles.map(f=>f.name).join(', ') : '');
-    addMsg(displayMsg, true);
+    const userDiv = addMsg(displayMsg, true);
     msgInput.value = '';
     msgInput.style.height = 'auto';
     sendBtn.disabled = true;
@@ -1047,6 +3966,7 @@ async function sendMessage() {
     const formData = new FormData();
     formData.append('chat_id', currentChatId);
     formData.append('message', msg);
+    formData.append('tier', settings.tier || 'auto');
     selectedFiles.forEach(f => formData.append('files', f));
     
     try {
@@ -1056,15 +3976,16 @@ async function sendMessage() {
         clearTimeout(timeout);
         const data = await res.json();
         hideTyping();
-        addMsg(data.response || '응답을 받지 못했습니다.', false);
-        
         if (data.tokens_used > 0) {
-            let info = `<span><i class="fas fa-coins"></i> ${data.tokens_used.toLocaleString()} 토큰</span>`;
-            if (data.cache_read > 0) info += `<span><i class="fas fa-bolt"></i> 캐시 ${data.cache_read.toLocaleString()}</span>`;
-            tokenInfo.innerHTML = info;
+            addMsgActions(userDiv, msgCount, true, displayMsg);
+            addMsg(data.response, false, true, msgCount + 1, data);
+            msgCount += 2;
+            showTokenInfo(data);
+        } else {
+            addMsg(data.response || '응답을 받지 못했습니다.', false);
         }
         if (data.title) headerTitle.textContent = data.title;
-        loadChatList();
+        setActiveChat(currentChatId);
     } catch(e) {
         hideTyping();
         addMsg('⚠️ ' + (e.name === 'AbortError' ? '요청 시간이 초과되었습니다.' : e.message), false);
@@ -1086,6 +4007,8 @@ document.addEventListener('click', e => {
 </script>
 </body>
 </html>'''
+# 서버에서 하이라이트한 코드 블록(.pyg)용 pygments 색상
+HTML = HTML.replace('</style>', PYGMENTS_CSS + '\n</style>', 1)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1093,5 +4016,10 @@ if __name__ == "__main__":
     print("🚀 하림님 코딩 챗봇 v2.0")
     print("=" * 50)
     print("📍 http://localhost:8000")
+    print(f"👷 워커: {WORKERS}개")
     print("=" * 50)
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if WORKERS > 1:
+        # 여러 프로세스는 import 문자열로만 띄울 수 있음 - data/ 파일을 잠금으로 공유
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
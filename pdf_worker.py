@@ -0,0 +1,18 @@
+"""
+PDF 페이지 추출 (병렬 추출 프로세스용)
+- app.py의 프로세스 풀(spawn)이 이 모듈만 불러오도록 따로 둠
+- import할 때 아무 것도 실행하지 않음 (채팅 저장소 로드, 폴더 생성, API 클라이언트 없음)
+"""
+import PyPDF2
+
+
+def extract_pages(path, pages):
+    """(별도 프로세스에서도 실행) 지정한 페이지들만 추출 - 한 페이지 실패는 그 페이지만 표시"""
+    reader = PyPDF2.PdfReader(path)
+    out = {}
+    for i in pages:
+        try:
+            out[i] = reader.pages[i].extract_text() or ""
+        except Exception as e:
+            out[i] = f"[페이지 {i + 1} 추출 실패: {type(e).__name__}]"
+    return out